@@ -1,7 +1,13 @@
+import time
+import numpy as np
 import pandas as pd
 from recomendar_productos import recomendar_productos
-from recomendar_llm import recomendar_con_llm
+from recomendar_llm import recomendar_con_llm, MODEL_NAME as MODELO_LLM
+from artefacto_embeddings import EXTENSION, leer_header
+from cache_semantico import CacheSemantico
+from reranker_cross_encoder import reordenar_con_cross_encoder, MODELO_CROSS_ENCODER_DEFECTO
 import logging
+from typing import Optional
 
 # --- Configuración de Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -9,59 +15,293 @@ logger = logging.getLogger(__name__)
 
 # --- Constantes de Configuración ---
 MODELO_EMBEDDING_FILTRADO = 'all-mpnet-base-v2'
-TOP_K_FILTRADO = 5 # Número de candidatos a pasar al LLM
+TOP_K_FILTRADO = 5 # Número de candidatos a pasar al LLM (modo fijo)
 
-def recomendar_hibrido(consulta: str):
+# --- Cascada y número adaptativo de candidatos ---
+TOP_K_RECOMENDACION = 3 # Tamaño del ranking final que se devuelve al usuario
+TOP_K_MINIMO = 3 # Mínimo de candidatos a pasar al LLM en modo adaptativo
+TOP_K_MAXIMO = 8 # Máximo de candidatos que se recuperan con SBERT en modo adaptativo
+UMBRAL_MARGEN_CASCADA = 0.08 # Margen top1 - top2 a partir del cual se confía en SBERT
+
+# --- Presupuesto de latencia ---
+PLAZO_HIBRIDO_S = 10.0 # Tiempo máximo por consulta; al vencer se responde con los candidatos de SBERT
+
+# --- Re-rankers disponibles para la Etapa 2 ---
+RERANKERS = ("llm", "cross_encoder")
+
+
+def calcular_margen(scores) -> float:
+    """Margen de confianza de SBERT: diferencia entre el primer y el segundo score."""
+    scores = np.asarray(scores, dtype=float)
+    if len(scores) < 2:
+        return float('inf')
+    return float(scores[0] - scores[1])
+
+
+def seleccionar_num_candidatos(scores, k_min: int = TOP_K_MINIMO, k_max: int = TOP_K_MAXIMO) -> int:
+    """
+    Elige cuántos candidatos pasar al LLM cortando en el mayor salto entre scores consecutivos.
+
+    Los scores deben venir ordenados de mayor a menor. El corte se busca entre k_min y k_max,
+    de modo que los candidatos que quedan fuera estén claramente por debajo de los que entran.
+    """
+    scores = np.asarray(scores, dtype=float)
+    if len(scores) <= k_min:
+        return len(scores)
+
+    k_max = min(k_max, len(scores))
+    saltos = scores[:-1] - scores[1:]
+    # saltos[n - 1] es la caída entre el candidato n y el n + 1 (cortar dejando n candidatos)
+    if k_max == len(scores):
+        # Cortar en k_max no deja nada afuera: no hay salto que medir en esa posición
+        saltos = np.append(saltos, -np.inf)
+    return int(k_min + np.argmax(saltos[k_min - 1:k_max]))
+
+
+def formatear_ranking(df_candidatos: pd.DataFrame, top_k: int = TOP_K_RECOMENDACION) -> str:
+    """Devuelve el orden de `df_candidatos` con el mismo formato de salida que se le exige al LLM."""
+    lineas = ["PRODUCTOS RECOMENDADOS:"]
+    for i, nombre in enumerate(df_candidatos['nombre'].head(top_k).tolist()):
+        lineas.append(f"{i+1}. {nombre}")
+    return "\n".join(lineas)
+
+
+def detalle_vacio() -> dict:
+    """Detalle de ejecución con todas las claves, para que cada camino devuelva la misma forma."""
+    return {
+        "llm_invocado": False,
+        "solicitudes_llm": 0,
+        "circuito_abierto": False,
+        "margen": None,
+        "num_candidatos": 0,
+        "latencia_sbert_s": 0.0,
+        "latencia_llm_s": 0.0,
+        "latencia_reranking_s": 0.0,
+        "latencia_total_s": 0.0,
+        "degradado": False,
+        "cache_hit": False,
+    }
+
+
+def version_cache_hibrido(
+    header: dict,
+    reranker: str,
+    cascada: bool,
+    candidatos_adaptativos: bool,
+    umbral_margen: float
+) -> str:
+    """
+    Versión de las entradas del cache: todo lo que cambia la respuesta de recomendar_hibrido.
+
+    Incluye el catálogo y el modelo de embeddings (del header del artefacto), el re-ranker y su
+    modelo, y la configuración de la cascada. El umbral de margen sólo cuenta con la cascada
+    activa: sin ella no se usa.
+    """
+    modelo_reranker = MODELO_LLM if reranker == "llm" else MODELO_CROSS_ENCODER_DEFECTO
+    partes = [
+        header['huella_catalogo'],
+        f"embeddings={header['model_name']}@{header.get('model_revision')}",
+        f"{reranker}={modelo_reranker}",
+        f"cascada={cascada}",
+        f"adaptativo={candidatos_adaptativos}",
+    ]
+    if cascada:
+        partes.append(f"umbral_margen={umbral_margen!r}")
+    return "|".join(partes)
+
+
+def guardar_en_cache(cache, consulta, version, respuesta, df, detalle, embedding):
+    """
+    Guarda en el cache una copia del DataFrame devuelto junto con el margen y el número de
+    candidatos, para que un acierto no comparta objetos con quien recibió la respuesta original.
+    """
+    entrada = {
+        "respuesta": respuesta,
+        "df": df.copy(),
+        "margen": detalle["margen"],
+        "num_candidatos": detalle["num_candidatos"],
+    }
+    cache.guardar(consulta, version, entrada, embedding=embedding)
+
+
+def recomendar_hibrido(
+    consulta: str,
+    cascada: bool = False,
+    candidatos_adaptativos: bool = False,
+    umbral_margen: float = UMBRAL_MARGEN_CASCADA,
+    plazo_s: Optional[float] = PLAZO_HIBRIDO_S,
+    reranker: str = "llm",
+    cache: Optional[CacheSemantico] = None
+):
     """
     Implementa un sistema de recomendación híbrido de dos etapas.
-    
+
     Etapa 1: Filtrado rápido con Embeddings (SBERT) para generar candidatos.
-    Etapa 2: Re-ranking y razonamiento con un LLM para la recomendación final.
+    Etapa 2: Re-ranking y razonamiento con un LLM para la recomendación final, o bien
+    re-ranking local con un cross-encoder (`reranker="cross_encoder"`).
+
+    Args:
+        consulta: La consulta del usuario en lenguaje natural.
+        cascada: Si es True, se omite el LLM cuando el margen top1 - top2 de SBERT
+            supera `umbral_margen` y se devuelve directamente el ranking de SBERT.
+        candidatos_adaptativos: Si es True, el número de candidatos que recibe el LLM
+            se elige según los saltos de score en vez de usar TOP_K_FILTRADO.
+        umbral_margen: Margen mínimo para considerar confiable el ranking de SBERT.
+        plazo_s: Presupuesto de latencia total de la consulta, en segundos. Si el LLM no
+            responde a tiempo (o falla, o su circuito está abierto) se devuelve el ranking de
+            SBERT. None desactiva el plazo.
+        reranker: "llm" (remoto, Groq) o "cross_encoder" (local, una pasada batcheada).
+        cache: (Opcional) Cache semántico. Si una consulta equivalente ya se respondió con el
+            mismo catálogo y la misma configuración, se devuelve esa respuesta sin ejecutar
+            ninguna de las dos etapas. Las respuestas degradadas no se guardan. En un acierto,
+            `margen` y `num_candidatos` son los de la ejecución cacheada y las latencias de
+            etapa valen 0 (no se ejecutó ninguna).
+
+    Returns:
+        La respuesta final (texto), el DataFrame de candidatos enviados al LLM y un
+        diccionario con el detalle de la ejecución (si se llamó al LLM, margen, latencias).
+        Si la etapa de filtrado no devuelve candidatos, la respuesta es None y el
+        DataFrame está vacío.
     """
+    if reranker not in RERANKERS:
+        raise ValueError(f"Re-ranker '{reranker}' no soportado. Opciones: {RERANKERS}")
+
     print("="*80)
-    print("      SISTEMA DE RECOMENDACIÓN HÍBRIDO (SBERT + LLM)")
+    print(f"      SISTEMA DE RECOMENDACIÓN HÍBRIDO (SBERT + {'LLM' if reranker == 'llm' else 'CROSS-ENCODER'})")
     print("="*80)
     print(f"CONSULTA: '{consulta}'\n")
 
+    inicio = time.perf_counter()
+    top_k_sbert = TOP_K_MAXIMO if (cascada or candidatos_adaptativos) else TOP_K_FILTRADO
+    path_embeddings = f"data/embeddings_{MODELO_EMBEDDING_FILTRADO}{EXTENSION}"
+
+    # --- CACHE SEMÁNTICO: consultas equivalentes ya respondidas ---
+    version_cache = None
+    if cache is not None:
+        try:
+            version_cache = version_cache_hibrido(
+                leer_header(path_embeddings)[0], reranker, cascada, candidatos_adaptativos, umbral_margen
+            )
+        except FileNotFoundError:
+            logger.warning(f"No se encontró {path_embeddings}; no se usa el cache semántico.")
+    if version_cache is not None:
+        embedding_cache = cache.codificar(consulta)
+        acierto = cache.buscar(consulta, version_cache, embedding=embedding_cache)
+        if acierto is not None:
+            entrada = acierto["respuesta"]
+            logger.info(f"Respuesta desde el cache semántico (similitud {acierto['similitud']:.3f}).")
+            print(f"Respuesta desde cache (consulta similar: '{acierto['consulta_cacheada']}').\n")
+            print(entrada["respuesta"])
+            detalle = detalle_vacio()
+            detalle.update({
+                "margen": entrada["margen"],
+                "num_candidatos": entrada["num_candidatos"],
+                "cache_hit": True,
+                "similitud_cache": acierto["similitud"],
+                "consulta_cacheada": acierto["consulta_cacheada"],
+                "latencia_total_s": time.perf_counter() - inicio,
+            })
+            # Copia: quien llama puede modificar el DataFrame sin alterar la entrada compartida
+            return entrada["respuesta"], entrada["df"].copy(), detalle
+
     # --- ETAPA 1: FILTRADO CON EMBEDDINGS ---
     logger.info(f"Iniciando Etapa 1: Filtrado con SBERT ({MODELO_EMBEDDING_FILTRADO})")
-    print(f"--- Etapa 1: Filtrando los {TOP_K_FILTRADO} mejores candidatos con SBERT... ---\n")
-    
-    path_embeddings = f"data/embeddings_{MODELO_EMBEDDING_FILTRADO}.npy"
-    path_metadata = f"data/metadata_{MODELO_EMBEDDING_FILTRADO}.json"
-    
+    print(f"--- Etapa 1: Filtrando los {top_k_sbert} mejores candidatos con SBERT... ---\n")
+
     # Obtenemos el DataFrame de recomendaciones de SBERT
     df_candidatos, metricas = recomendar_productos(
         consulta=consulta,
-        top_k=TOP_K_FILTRADO,
-        path_embeddings=path_embeddings,
-        path_metadata=path_metadata
+        top_k=top_k_sbert,
+        path_embeddings=path_embeddings
     )
 
     if df_candidatos is None or df_candidatos.empty:
         logger.warning("La etapa de filtrado no devolvió candidatos. Terminando proceso.")
         print("No se encontraron productos relevantes en la primera etapa.")
-        return
+        detalle = detalle_vacio()
+        detalle["latencia_total_s"] = time.perf_counter() - inicio
+        return None, pd.DataFrame(), detalle
+
+    scores = df_candidatos['score'].to_numpy()
+    margen = calcular_margen(scores)
+    detalle = detalle_vacio()
+    detalle["margen"] = margen
+    detalle["num_candidatos"] = len(df_candidatos)
+    detalle["latencia_sbert_s"] = time.perf_counter() - inicio
+
+    # --- CASCADA: si SBERT está seguro, no se paga la llamada al LLM ---
+    if cascada and margen >= umbral_margen:
+        logger.info(f"Margen SBERT {margen:.4f} >= {umbral_margen:.4f}: se omite la Etapa 2.")
+        print(f"SBERT confiado (margen {margen:.4f}). Se devuelve su ranking sin llamar al LLM.\n")
+        respuesta = formatear_ranking(df_candidatos)
+        print(respuesta)
+        detalle["latencia_total_s"] = time.perf_counter() - inicio
+        if version_cache is not None:
+            guardar_en_cache(cache, consulta, version_cache, respuesta, df_candidatos, detalle, embedding_cache)
+        return respuesta, df_candidatos, detalle
+
+    if candidatos_adaptativos:
+        num_candidatos = seleccionar_num_candidatos(scores)
+    else:
+        num_candidatos = TOP_K_FILTRADO
+    df_candidatos = df_candidatos.head(num_candidatos)
+    detalle["num_candidatos"] = len(df_candidatos)
 
     # Convertir el DataFrame a una lista de diccionarios para el LLM
     productos_candidatos = df_candidatos.to_dict(orient='records')
-    
+
     print("Candidatos seleccionados por SBERT:")
     print(df_candidatos[['nombre', 'categoria', 'score']])
     print("\n" + "."*80 + "\n")
 
+    # --- ETAPA 2 (ALTERNATIVA): RE-RANKING LOCAL CON CROSS-ENCODER ---
+    if reranker == "cross_encoder":
+        logger.info(f"Iniciando Etapa 2: Re-ranking de {len(productos_candidatos)} candidatos con cross-encoder.")
+        print("--- Etapa 2: Cross-encoder puntúa los candidatos... ---\n")
+
+        inicio_reranking = time.perf_counter()
+        df_reordenado = reordenar_con_cross_encoder(consulta, df_candidatos)
+        detalle["latencia_reranking_s"] = time.perf_counter() - inicio_reranking
+        detalle["latencia_total_s"] = time.perf_counter() - inicio
+
+        respuesta = formatear_ranking(df_reordenado)
+        print(respuesta)
+        if version_cache is not None:
+            guardar_en_cache(cache, consulta, version_cache, respuesta, df_reordenado, detalle, embedding_cache)
+        return respuesta, df_reordenado, detalle
+
     # --- ETAPA 2: RE-RANKING CON LLM ---
     logger.info(f"Iniciando Etapa 2: Re-ranking de {len(productos_candidatos)} candidatos con LLM.")
     print("--- Etapa 2: LLM analiza los candidatos para la recomendación final... ---\n")
 
-    respuesta_llm = recomendar_con_llm(consulta, productos_candidatos=productos_candidatos)
-    
+    inicio_llm = time.perf_counter()
+    plazo_restante = None if plazo_s is None else plazo_s - (inicio_llm - inicio)
+    if plazo_restante is not None and plazo_restante <= 0:
+        logger.warning("El filtrado con SBERT consumió todo el plazo; no se llama al LLM.")
+        respuesta_llm = None
+    else:
+        # recomendar_con_llm marca llm_invocado sólo si la solicitud salió (no con el circuito abierto)
+        respuesta_llm = recomendar_con_llm(
+            consulta, productos_candidatos=productos_candidatos, plazo_s=plazo_restante, detalle=detalle
+        )
+    detalle["latencia_llm_s"] = time.perf_counter() - inicio_llm
+
+    if not respuesta_llm:
+        # Degradación: los candidatos de SBERT ya están calculados y ordenados
+        logger.warning("Sin respuesta del LLM; se devuelve el ranking de SBERT.")
+        respuesta_llm = formatear_ranking(df_candidatos)
+        detalle["degradado"] = True
+    detalle["latencia_total_s"] = time.perf_counter() - inicio
+
+    if version_cache is not None and not detalle["degradado"]:
+        guardar_en_cache(cache, consulta, version_cache, respuesta_llm, df_candidatos, detalle, embedding_cache)
+
     print(respuesta_llm)
-    
+
     # Return tanto la respuesta final como la lista de candidatos para evaluación
-    return respuesta_llm, df_candidatos
+    return respuesta_llm, df_candidatos, detalle
 
 
 if __name__ == '__main__':
     consulta_ejemplo = "Busco un dispositivo que sea elegante, moderno y fácil de llevar a todos lados, ideal para un profesional ocupado."
-    recomendar_hibrido(consulta_ejemplo) 
\ No newline at end of file
+    recomendar_hibrido(consulta_ejemplo, cascada=True, candidatos_adaptativos=True)
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Constantes del formato ---
+# Layout del archivo: MAGIC (8 bytes) | largo del header (uint64 little-endian) |
+# header JSON (utf-8, con padding) | matriz de embeddings en orden C.
+# Los datos arrancan alineados a ALINEACION bytes para poder abrirlos con np.memmap.
+MAGIC = b"IQOSEMB1"
+VERSION_FORMATO = 1
+ALINEACION = 64
+EXTENSION = ".emb"
+# Todo lo que el artefacto y el índice BM25 derivan del catálogo: la descripción se embebe,
+# el nombre se indexa en BM25. Una sola huella permite hashear el catálogo una vez por consulta.
+COLUMNAS_HUELLA = ['id', 'nombre', 'descripcion']
+
+
+def huella_catalogo(df: pd.DataFrame) -> str:
+    """
+    Calcula un hash SHA-256 del contenido del catálogo usado para los embeddings y el índice BM25.
+
+    Las filas se ordenan por id antes de hashear, así que reordenar el CSV no cambia la huella;
+    el orden se valida aparte con el vector de ids del header.
+    """
+    filas = df[COLUMNAS_HUELLA].sort_values('id').astype(str).values.tolist()
+    contenido = json.dumps(filas, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+
+def guardar_artefacto(
+    path: str,
+    embeddings: np.ndarray,
+    ids: Sequence[int],
+    model_name: str,
+    huella: str,
+    revision: Optional[str] = None,
+    normalizado: bool = False
+) -> Dict:
+    """Guarda los embeddings y su header autodescriptivo en un único archivo."""
+    embeddings = np.ascontiguousarray(embeddings)
+    if embeddings.ndim != 2:
+        raise ValueError(f"Se esperaba una matriz 2D de embeddings, se recibió forma {embeddings.shape}.")
+    if len(ids) != embeddings.shape[0]:
+        raise ValueError(f"Hay {len(ids)} ids para {embeddings.shape[0]} embeddings.")
+
+    header = {
+        "version_formato": VERSION_FORMATO,
+        "model_name": model_name,
+        "model_revision": revision,
+        "dim": int(embeddings.shape[1]),
+        "num_productos": int(embeddings.shape[0]),
+        "dtype": embeddings.dtype.str,
+        "normalizado": bool(normalizado),
+        "huella_catalogo": huella,
+        "ids": [int(i) for i in ids],
+    }
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    inicio_datos = len(MAGIC) + 8 + len(header_bytes)
+    padding = (-inicio_datos) % ALINEACION
+    header_bytes += b" " * padding
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.write(embeddings.tobytes(order='C'))
+
+    logger.info(f"Artefacto de embeddings guardado en {path} (modelo: {model_name}, forma: {embeddings.shape})")
+    return header
+
+
+def leer_header(path: str) -> Tuple[Dict, int]:
+    """Lee el header del artefacto y devuelve (header, offset donde empiezan los datos)."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{path} no es un artefacto de embeddings válido (magic {magic!r}).")
+        largo_header = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(largo_header).decode('utf-8'))
+
+    if header.get("version_formato") != VERSION_FORMATO:
+        raise ValueError(f"Versión de formato no soportada en {path}: {header.get('version_formato')}.")
+    return header, len(MAGIC) + 8 + largo_header
+
+
+def cargar_artefacto(
+    path: str,
+    df_catalogo: Optional[pd.DataFrame] = None,
+    model_name: Optional[str] = None,
+    huella: Optional[str] = None
+) -> Tuple[np.ndarray, Dict]:
+    """
+    Abre el artefacto sin copiar los datos (np.memmap de solo lectura) y valida su header.
+
+    Si se pasa el catálogo, se verifica que la huella de contenido coincida y los embeddings
+    se devuelven en el mismo orden de filas que `df_catalogo`. Si se pasa `model_name`,
+    se verifica que coincida con el modelo que generó el artefacto. `huella` evita recalcular
+    la huella del catálogo si quien llama ya la tiene.
+    Ante cualquier inconsistencia se lanza ValueError.
+    """
+    header, offset = leer_header(path)
+    forma = (header["num_productos"], header["dim"])
+    embeddings = np.memmap(path, dtype=np.dtype(header["dtype"]), mode='r', offset=offset, shape=forma)
+
+    if len(header["ids"]) != forma[0]:
+        raise ValueError(f"El header de {path} declara {forma[0]} productos pero tiene {len(header['ids'])} ids.")
+
+    if model_name is not None and model_name != header["model_name"]:
+        raise ValueError(
+            f"El artefacto {path} fue generado con '{header['model_name']}', no con '{model_name}'."
+        )
+
+    if df_catalogo is not None:
+        if huella is None:
+            huella = huella_catalogo(df_catalogo)
+        if huella != header["huella_catalogo"]:
+            raise ValueError(
+                f"El catálogo no coincide con el usado para generar {path}. "
+                "Regenerá los embeddings con generar_embeddings_iqos.py."
+            )
+        embeddings = alinear_con_catalogo(embeddings, header["ids"], df_catalogo)
+
+    return embeddings, header
+
+
+def alinear_con_catalogo(embeddings: np.ndarray, ids: Sequence[int], df_catalogo: pd.DataFrame) -> np.ndarray:
+    """Reordena los embeddings para que la fila i corresponda a la fila i del catálogo."""
+    ids_catalogo = df_catalogo['id'].to_numpy()
+    ids_artefacto = np.asarray(ids)
+    if np.array_equal(ids_catalogo, ids_artefacto):
+        # Mismo orden: se devuelve el memmap tal cual, sin copiar
+        return embeddings
+
+    logger.info("El orden del catálogo difiere del artefacto; reordenando embeddings por id.")
+    posicion_por_id = {int(i): pos for pos, i in enumerate(ids_artefacto)}
+    try:
+        posiciones = [posicion_por_id[int(i)] for i in ids_catalogo]
+    except KeyError as e:
+        raise ValueError(f"El producto con id {e} no existe en el artefacto de embeddings.")
+    return np.asarray(embeddings[posiciones])
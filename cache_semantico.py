@@ -0,0 +1,146 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+# Modelo multilingüe entrenado con paráfrasis: las consultas llegan en español y con variantes
+MODELO_CACHE_DEFECTO = 'paraphrase-multilingual-MiniLM-L12-v2'
+UMBRAL_SIMILITUD_CACHE = 0.92 # Similitud coseno mínima para responder desde el cache
+MAX_ENTRADAS_CACHE = 10000
+TTL_CACHE_S = 24 * 3600.0
+
+
+def version_candidatos(productos: List[Dict]) -> str:
+    """Firma de un conjunto de candidatos (independiente del orden) para usarla como versión."""
+    nombres = sorted(str(p.get('id', p['nombre'])) for p in productos)
+    return "candidatos:" + hashlib.sha256("|".join(nombres).encode('utf-8')).hexdigest()
+
+
+class CacheSemantico:
+    """
+    Cache de respuestas indexado por el embedding de la consulta.
+
+    Una consulta nueva se responde desde el cache si su vecino más cercano (similitud coseno
+    sobre embeddings normalizados) supera `umbral_similitud` y fue guardado con la misma
+    `version` (huella del catálogo o del conjunto de candidatos, más la configuración).
+    Los embeddings viven en una matriz preasignada, así que la búsqueda es un único producto
+    matriz-vector. Las entradas vencen a los `ttl_s` segundos y, con el cache lleno, se
+    descarta la usada hace más tiempo (LRU).
+    """
+
+    def __init__(
+        self,
+        umbral_similitud: float = UMBRAL_SIMILITUD_CACHE,
+        max_entradas: int = MAX_ENTRADAS_CACHE,
+        ttl_s: float = TTL_CACHE_S,
+        nombre_modelo: str = MODELO_CACHE_DEFECTO
+    ):
+        self.umbral_similitud = umbral_similitud
+        self.max_entradas = max_entradas
+        self.ttl_s = ttl_s
+        self.nombre_modelo = nombre_modelo
+        self._modelo: Optional[SentenceTransformer] = None
+
+        self._embeddings: Optional[np.ndarray] = None # Se asigna al conocer la dimensión
+        self._ocupado = np.zeros(max_entradas, dtype=bool)
+        self._expira = np.zeros(max_entradas)
+        self._version = np.empty(max_entradas, dtype=object)
+        self._entradas: "OrderedDict[int, Dict]" = OrderedDict() # slot -> entrada, en orden LRU
+        self._lock = threading.Lock()
+
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+
+    def codificar(self, consulta: str) -> np.ndarray:
+        """Embedding normalizado de la consulta (el modelo se carga la primera vez)."""
+        if self._modelo is None:
+            logger.info(f"Cargando modelo del cache semántico: {self.nombre_modelo}")
+            self._modelo = SentenceTransformer(self.nombre_modelo)
+        return self._modelo.encode([consulta], show_progress_bar=False, normalize_embeddings=True)[0]
+
+    def _liberar_vencidas(self, ahora: float):
+        vencidas = np.flatnonzero(self._ocupado & (self._expira <= ahora))
+        for slot in vencidas:
+            self._ocupado[slot] = False
+            self._version[slot] = None
+            self._entradas.pop(int(slot), None)
+
+    def buscar(self, consulta: str, version: str, embedding: Optional[np.ndarray] = None) -> Optional[Dict]:
+        """
+        Busca una respuesta guardada para una consulta equivalente.
+
+        Devuelve un diccionario con `respuesta`, `consulta_cacheada` y `similitud`, o None.
+        """
+        if embedding is None:
+            embedding = self.codificar(consulta)
+
+        with self._lock:
+            self._liberar_vencidas(time.time())
+            candidatos = np.flatnonzero(self._ocupado & (self._version == version))
+            if self._embeddings is None or len(candidatos) == 0:
+                self.fallos += 1
+                return None
+
+            similitudes = self._embeddings[candidatos] @ embedding
+            mejor = int(np.argmax(similitudes))
+            similitud = float(similitudes[mejor])
+            if similitud < self.umbral_similitud:
+                self.fallos += 1
+                return None
+
+            slot = int(candidatos[mejor])
+            self._entradas.move_to_end(slot)
+            self.aciertos += 1
+            entrada = self._entradas[slot]
+            return {
+                "respuesta": entrada["respuesta"],
+                "consulta_cacheada": entrada["consulta"],
+                "similitud": similitud,
+            }
+
+    def guardar(self, consulta: str, version: str, respuesta: Any, embedding: Optional[np.ndarray] = None):
+        """Guarda la respuesta final de una consulta, desalojando la entrada LRU si no hay lugar."""
+        if embedding is None:
+            embedding = self.codificar(consulta)
+
+        with self._lock:
+            ahora = time.time()
+            self._liberar_vencidas(ahora)
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_entradas, len(embedding)), dtype=np.float32)
+
+            libres = np.flatnonzero(~self._ocupado)
+            if len(libres):
+                slot = int(libres[0])
+            else:
+                slot, _ = self._entradas.popitem(last=False)
+                self.desalojos += 1
+
+            self._embeddings[slot] = embedding
+            self._ocupado[slot] = True
+            self._expira[slot] = ahora + self.ttl_s
+            self._version[slot] = version
+            self._entradas[slot] = {"consulta": consulta, "respuesta": respuesta}
+            self._entradas.move_to_end(slot)
+
+    def estadisticas(self) -> Dict:
+        """Aciertos, fallos, tasa de aciertos, desalojos y tamaño actual del cache."""
+        total = self.aciertos + self.fallos
+        return {
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": self.aciertos / total if total else 0.0,
+            "desalojos": self.desalojos,
+            "entradas": int(self._ocupado.sum()),
+        }
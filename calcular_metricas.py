@@ -1,6 +1,15 @@
 import json
+import os
+import hashlib
+import logging
 import numpy as np
 from sklearn.metrics import ndcg_score
+from registro_resultados import leer_registros, PATH_RESULTADOS_JSONL
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+PATH_ESTADO_METRICAS = "eval/agregados_metricas.json"
 
 def calcular_hit_rate_at_k(ranking: list, ground_truth: dict, k: int) -> float:
     """
@@ -30,49 +39,146 @@ def calcular_ndcg_at_k(ranking: list, ground_truth: dict, k: int) -> float:
     # ndcg_score espera [[true_relevance]], [[predicted_scores]]
     return ndcg_score([true_relevance], [predicted_scores], k=k)
 
-def analizar_resultados(k=3):
+def identificar_log(path_resultados: str) -> dict:
     """
-    Carga los resultados y el ground truth, y calcula las métricas.
+    Identidad del log al que pertenece el offset: ruta, inodo y hash de la primera línea.
+
+    Un log distinto, reescrito o rotado cambia alguno de los tres aunque sea más largo que el
+    offset guardado, y entonces el offset no sirve.
     """
-    # Cargar los archivos JSON
-    with open('eval/resultados_modelos.json', 'r', encoding='utf-8') as f:
-        resultados_data = json.load(f)
-    
-    # Diccionario para almacenar los promedios de las métricas
-    metricas_promedio = {
-        'SBERT': {'NDCG@k': [], 'HitRate@k': []},
-        'LLM_Puro': {'NDCG@k': [], 'HitRate@k': []},
-        'Hibrido': {'NDCG@k': [], 'HitRate@k': []}
+    if not os.path.exists(path_resultados):
+        return {'path': os.path.abspath(path_resultados), 'inodo': None, 'hash_primera_linea': None}
+    with open(path_resultados, 'rb') as f:
+        primera_linea = f.readline()
+    return {
+        'path': os.path.abspath(path_resultados),
+        'inodo': os.stat(path_resultados).st_ino,
+        'hash_primera_linea': hashlib.sha256(primera_linea).hexdigest(),
     }
 
+def offset_valido(path_resultados: str, offset: int) -> bool:
+    """El offset guardado tiene que caer dentro del archivo y justo después de un salto de línea."""
+    if offset == 0:
+        return True
+    if not os.path.exists(path_resultados) or os.path.getsize(path_resultados) < offset:
+        return False
+    with open(path_resultados, 'rb') as f:
+        f.seek(offset - 1)
+        return f.read(1) == b"\n"
+
+def cargar_estado(path_estado: str, k: int) -> dict:
+    """
+    Carga los agregados acumulados en corridas anteriores.
+
+    Si no existen, se calcularon con otro k o tienen el formato viejo (sin separar por
+    corrida), se empieza de cero.
+    """
+    if os.path.exists(path_estado):
+        with open(path_estado, 'r', encoding='utf-8') as f:
+            estado = json.load(f)
+        if estado.get('k') == k and 'runs' in estado:
+            return estado
+    return estado_vacio(k)
+
+def estado_vacio(k: int) -> dict:
+    """Agregados sin registros procesados: sumas por corrida (run_id) y por modelo."""
+    return {'k': k, 'offset': 0, 'runs': {}}
+
+def guardar_estado(estado: dict, path_estado: str):
+    """Guarda los agregados y el offset hasta donde se procesó el log."""
+    directorio = os.path.dirname(path_estado)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+    with open(path_estado, 'w', encoding='utf-8') as f:
+        json.dump(estado, f, ensure_ascii=False, indent=4)
+
+def analizar_resultados(k=3, path_resultados=PATH_RESULTADOS_JSONL, path_estado=PATH_ESTADO_METRICAS,
+                        incremental=True, verbose=True):
+    """
+    Recorre el log JSONL de resultados y calcula las métricas de forma incremental.
+
+    Sólo se mantienen sumas y conteos por corrida (`run_id`) y modelo, así que la memoria no
+    depende del tamaño del log y corridas distintas (otro prompt, otro modelo, una
+    re-ejecución) nunca se mezclan. Con `incremental=True` se retoma desde el offset guardado
+    en `path_estado` y sólo se procesan los registros nuevos; si el estado se guardó para otro
+    log (ruta, inodo o primera línea distintos) se recalcula desde cero.
+
+    Returns:
+        Un diccionario {run_id: {modelo: {'NDCG@k', 'HitRate@k', 'n', 'n_degradados'}}}.
+        Las filas marcadas en `degradados` (el LLM no respondió y se devolvió el ranking de
+        SBERT) no entran en los promedios; se informan aparte en `n_degradados`.
+    """
+    estado = cargar_estado(path_estado, k) if incremental else estado_vacio(k)
+    log = identificar_log(path_resultados)
+    if estado['offset'] and (estado.get('log') != log or not offset_valido(path_resultados, estado['offset'])):
+        logger.warning(
+            f"El estado en {path_estado} corresponde a otro log (o {path_resultados} fue reescrito); "
+            "recalculando desde cero."
+        )
+        estado = estado_vacio(k)
+    estado['log'] = log
+
     print(f"--- Análisis de Métricas (k={k}) ---")
 
-    for i, resultado in enumerate(resultados_data):
-        print(f"\nConsulta {i+1}: \"{resultado['consulta'][:40]}...\"")
+    nuevos = 0
+    for resultado, offset in leer_registros(path_resultados, estado['offset']):
+        nuevos += 1
+        if verbose:
+            print(f"\nConsulta {resultado.get('consulta_id', nuevos)}: \"{resultado['consulta'][:40]}...\"")
         ground_truth = resultado['ground_truth']
+        modelos_run = estado['runs'].setdefault(str(resultado.get('run_id', 'sin_run')), {})
         
+        degradados = set(resultado.get('degradados', []))
         for modelo, ranking in resultado['resultados'].items():
+            acumulado = modelos_run.setdefault(
+                modelo, {'n': 0, 'n_degradados': 0, 'suma_NDCG@k': 0.0, 'suma_HitRate@k': 0.0}
+            )
+            if modelo in degradados:
+                # El ranking es el fallback de SBERT, no el del modelo: se cuenta aparte
+                acumulado['n_degradados'] = acumulado.get('n_degradados', 0) + 1
+                if verbose:
+                    print(f"  - {modelo}: Respuesta degradada (fallback a SBERT), saltando cálculo.")
+                continue
             if not ranking or "Error" in ranking[0]:
-                print(f"  - {modelo}: Ranking con errores, saltando cálculo.")
+                if verbose:
+                    print(f"  - {modelo}: Ranking con errores, saltando cálculo.")
                 continue
 
             ndcg = calcular_ndcg_at_k(ranking, ground_truth, k)
             hit_rate = calcular_hit_rate_at_k(ranking, ground_truth, k)
-            
-            metricas_promedio[modelo]['NDCG@k'].append(ndcg)
-            metricas_promedio[modelo]['HitRate@k'].append(hit_rate)
 
-            print(f"  - {modelo}: NDCG@{k} = {ndcg:.4f}, HitRate@{k} = {hit_rate:.4f}")
+            acumulado['n'] += 1
+            acumulado['suma_NDCG@k'] += float(ndcg)
+            acumulado['suma_HitRate@k'] += float(hit_rate)
+
+            if verbose:
+                print(f"  - {modelo}: NDCG@{k} = {ndcg:.4f}, HitRate@{k} = {hit_rate:.4f}")
+
+        estado['offset'] = offset
+
+    if incremental:
+        guardar_estado(estado, path_estado)
 
     # Calcular y mostrar los promedios finales
-    print("\n--- Resultados Promedio ---")
-    for modelo, metricas in metricas_promedio.items():
-        avg_ndcg = np.mean(metricas['NDCG@k']) if metricas['NDCG@k'] else 0
-        avg_hit_rate = np.mean(metricas['HitRate@k']) if metricas['HitRate@k'] else 0
-        print(f"Modelo: {modelo}")
-        print(f"  - NDCG@{k} Promedio: {avg_ndcg:.4f}")
-        print(f"  - HitRate@{k} Promedio: {avg_hit_rate:.4f}")
-        print("-" * 25)
+    print(f"\n--- Resultados Promedio ({nuevos} registros nuevos) ---")
+    promedios = {}
+    for run_id, modelos_run in estado['runs'].items():
+        print(f"=== Corrida: {run_id} ===")
+        promedios[run_id] = {}
+        for modelo, acumulado in modelos_run.items():
+            n = acumulado['n']
+            avg_ndcg = acumulado['suma_NDCG@k'] / n if n else 0
+            avg_hit_rate = acumulado['suma_HitRate@k'] / n if n else 0
+            n_degradados = acumulado.get('n_degradados', 0)
+            promedios[run_id][modelo] = {
+                'NDCG@k': avg_ndcg, 'HitRate@k': avg_hit_rate, 'n': n, 'n_degradados': n_degradados
+            }
+            print(f"Modelo: {modelo} (n={n}, degradadas excluidas={n_degradados})")
+            print(f"  - NDCG@{k} Promedio: {avg_ndcg:.4f}")
+            print(f"  - HitRate@{k} Promedio: {avg_hit_rate:.4f}")
+            print("-" * 25)
+
+    return promedios
 
 if __name__ == "__main__":
-    analizar_resultados(k=3) 
\ No newline at end of file
+    analizar_resultados(k=3)
@@ -2,20 +2,33 @@ import json
 import os
 import pandas as pd
 import re
+import time
+from datetime import datetime
+import numpy as np
 from dotenv import load_dotenv
 
 # Cargar las funciones de recomendación de los otros scripts
 from recomendar_productos import recomendar_productos
-from recomendar_llm import recomendar_con_llm
-from Recomendar_hibrido import recomendar_hibrido
+from recomendar_llm import (
+    recomendar_con_llm, recomendar_con_llm_empaquetado, construir_prompt, construir_prompt_multiple,
+    TAM_PAQUETE_DEFECTO
+)
+from Recomendar_hibrido import recomendar_hibrido, UMBRAL_MARGEN_CASCADA
+from calcular_metricas import calcular_ndcg_at_k
+from artefacto_embeddings import EXTENSION
+from cache_semantico import CacheSemantico, UMBRAL_SIMILITUD_CACHE
+from registro_resultados import agregar_registro, PATH_RESULTADOS_JSONL, PATH_RESPUESTAS_JSONL
 
 def parsear_recomendaciones_llm(respuesta_texto: str, top_k=3) -> list:
     """
     Parser mejorado - múltiples formatos de respuesta del LLM
     """
+    # 0. Sin respuesta (fallo del LLM o sin candidatos): se marca para que las métricas la salteen
+    if not respuesta_texto:
+        return rellenar_lista(["Error: sin respuesta"], top_k)
     
     # 1. Buscar sección formal "PRODUCTOS RECOMENDADOS:"
-        match = re.search(r"PRODUCTOS RECOMENDADOS:\s*\n(.*?)$", respuesta_texto, re.DOTALL | re.IGNORECASE)
+    match = re.search(r"PRODUCTOS RECOMENDADOS:\s*\n(.*?)$", respuesta_texto, re.DOTALL | re.IGNORECASE)
     if match:
         lista_texto = match.group(1)
         items = re.findall(r"^\s*\d+\.\s*(.+)$", lista_texto, re.MULTILINE)
@@ -118,9 +131,12 @@ def rellenar_lista(productos: list, top_k: int) -> list:
     return productos[:top_k]
 
 
-def ejecutar_evaluacion(k=3):
+def ejecutar_evaluacion(k=3, path_resultados=PATH_RESULTADOS_JSONL, path_respuestas=PATH_RESPUESTAS_JSONL):
     """
     Ejecuta todos los modelos contra el ground truth y guarda los resultados.
+
+    Cada consulta se agrega apenas termina como una línea JSONL: los rankings van a
+    `path_resultados` y las respuestas crudas del LLM a `path_respuestas`.
     """
     load_dotenv()
     api_key = os.environ.get("GROQ_API_KEY")
@@ -132,7 +148,7 @@ def ejecutar_evaluacion(k=3):
 
     df_catalogo = pd.read_csv('src/productos_iqos.csv')
 
-    resultados_evaluacion = []
+    run_id = datetime.now().isoformat(timespec='seconds')
 
     print("Ejecutando evaluación para todos los modelos...")
 
@@ -143,8 +159,7 @@ def ejecutar_evaluacion(k=3):
         # 1. Modelo SBERT
         recomendaciones_sbert_df, _ = recomendar_productos(
             consulta, 
-            path_embeddings=f"data/embeddings_all-mpnet-base-v2.npy",
-            path_metadata=f"data/metadata_all-mpnet-base-v2.json",
+            path_embeddings=f"data/embeddings_all-mpnet-base-v2{EXTENSION}",
             path_productos="data/iqos_products.csv",
             top_k=k
         )
@@ -156,28 +171,244 @@ def ejecutar_evaluacion(k=3):
         ranking_llm_puro = parsear_recomendaciones_llm(respuesta_llm_puro, top_k=k)
 
         # 3. Modelo Híbrido
-        respuesta_hibrida_texto, df_candidatos_hibrido = recomendar_hibrido(consulta)
+        # Sin plazo: la evaluación mide el re-ranking, no la degradación por latencia. Si el LLM
+        # igual falla, la fila se marca como degradada para que las métricas no la cuenten como híbrida.
+        respuesta_hibrida_texto, df_candidatos_hibrido, detalle_hibrido = recomendar_hibrido(consulta, plazo_s=None)
         # ✅ CORREGIDO: Usamos el re-ranking del LLM, no el ranking de SBERT
         ranking_hibrido = parsear_recomendaciones_llm(respuesta_hibrida_texto, top_k=k)
 
+        # 4. Híbrido con cross-encoder local (sin LLM)
+        respuesta_cross_encoder, _, _ = recomendar_hibrido(consulta, reranker="cross_encoder", plazo_s=None)
+        ranking_cross_encoder = parsear_recomendaciones_llm(respuesta_cross_encoder, top_k=k)
+
 
-        resultados_evaluacion.append({
+        agregar_registro(path_resultados, {
+            "run_id": run_id,
+            "consulta_id": i + 1,
             "consulta": consulta,
             "ground_truth": item['relevancia'],
             "resultados": {
                 "SBERT": ranking_sbert,
                 "LLM_Puro": ranking_llm_puro,
-                "Hibrido": ranking_hibrido
+                "Hibrido": ranking_hibrido,
+                "CrossEncoder": ranking_cross_encoder
             },
-            "respuesta_llm_puro": respuesta_llm_puro,
-            "respuesta_hibrida": respuesta_hibrida_texto
+            "degradados": ["Hibrido"] if detalle_hibrido["degradado"] else []
         })
+        for modelo, respuesta in (("LLM_Puro", respuesta_llm_puro), ("Hibrido", respuesta_hibrida_texto)):
+            agregar_registro(path_respuestas, {
+                "run_id": run_id,
+                "consulta_id": i + 1,
+                "modelo": modelo,
+                "respuesta": respuesta
+            })
+
+    print(f"\nEvaluación completada. Resultados agregados a '{path_resultados}' (run {run_id})")
+
+def evaluar_cascada(k=3, umbral_margen=UMBRAL_MARGEN_CASCADA):
+    """
+    Compara el híbrido clásico (siempre LLM, TOP_K_FILTRADO fijo) contra el modo cascada
+    con número adaptativo de candidatos. Reporta tasa de omisión del LLM, latencia
+    ahorrada y diferencia de NDCG@k contra el ground truth.
+    """
+    load_dotenv()
+    if not os.environ.get("GROQ_API_KEY"):
+        raise ValueError("La variable de entorno GROQ_API_KEY no está configurada.")
+
+    with open('eval/ground_truth.json', 'r', encoding='utf-8') as f:
+        ground_truth_data = json.load(f)
+
+    latencias_base, latencias_cascada = [], []
+    ndcg_base, ndcg_cascada = [], []
+    omitidas = 0
+    degradadas = 0
+
+    print(f"Evaluando cascada (umbral de margen = {umbral_margen})...")
+
+    for i, item in enumerate(ground_truth_data):
+        consulta = item['consulta']
+        ground_truth = item['relevancia']
+        print(f"Procesando consulta {i+1}/{len(ground_truth_data)}: \"{consulta[:50]}...\"")
+
+        inicio = time.perf_counter()
+        respuesta_base, _, detalle_base = recomendar_hibrido(consulta, plazo_s=None)
+        latencia_base = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        respuesta_cascada, _, detalle = recomendar_hibrido(
+            consulta, cascada=True, candidatos_adaptativos=True, umbral_margen=umbral_margen, plazo_s=None
+        )
+        latencia_cascada = time.perf_counter() - inicio
+
+        if respuesta_base is None or respuesta_cascada is None:
+            print("  - Sin candidatos en la etapa de filtrado, se omite la consulta.")
+            continue
+        if detalle_base["degradado"] or detalle["degradado"]:
+            # Sin respuesta del LLM el resultado es el ranking de SBERT: no compara los dos modos
+            print("  - El LLM no respondió (respuesta degradada), se omite la consulta.")
+            degradadas += 1
+            continue
+
+        if not detalle["llm_invocado"]:
+            omitidas += 1
+
+        latencias_base.append(latencia_base)
+        latencias_cascada.append(latencia_cascada)
+        ndcg_base.append(calcular_ndcg_at_k(parsear_recomendaciones_llm(respuesta_base, top_k=k), ground_truth, k))
+        ndcg_cascada.append(calcular_ndcg_at_k(parsear_recomendaciones_llm(respuesta_cascada, top_k=k), ground_truth, k))
+
+    total = len(ndcg_base)
+    resumen = {
+        "umbral_margen": umbral_margen,
+        "consultas_degradadas": degradadas,
+        "tasa_omision_llm": omitidas / total if total else 0.0,
+        "latencia_media_base_s": float(np.mean(latencias_base)) if total else 0.0,
+        "latencia_media_cascada_s": float(np.mean(latencias_cascada)) if total else 0.0,
+        f"NDCG@{k}_base": float(np.mean(ndcg_base)) if total else 0.0,
+        f"NDCG@{k}_cascada": float(np.mean(ndcg_cascada)) if total else 0.0,
+    }
+    resumen["latencia_ahorrada_s"] = resumen["latencia_media_base_s"] - resumen["latencia_media_cascada_s"]
+    resumen[f"delta_NDCG@{k}"] = resumen[f"NDCG@{k}_cascada"] - resumen[f"NDCG@{k}_base"]
+
+    print("\n--- Resultados Cascada ---")
+    print(f"  - LLM omitido en {omitidas}/{total} consultas ({resumen['tasa_omision_llm']:.1%})")
+    print(f"  - Consultas descartadas por respuesta degradada: {degradadas}")
+    print(f"  - Latencia media: {resumen['latencia_media_base_s']:.3f}s -> {resumen['latencia_media_cascada_s']:.3f}s "
+          f"(ahorro {resumen['latencia_ahorrada_s']:.3f}s)")
+    print(f"  - NDCG@{k}: {resumen[f'NDCG@{k}_base']:.4f} -> {resumen[f'NDCG@{k}_cascada']:.4f} "
+          f"(delta {resumen[f'delta_NDCG@{k}']:+.4f})")
+
+    os.makedirs('eval', exist_ok=True)
+    with open('eval/resultados_cascada.json', 'w', encoding='utf-8') as f:
+        json.dump(resumen, f, ensure_ascii=False, indent=4)
+
+    return resumen
+
+def evaluar_empaquetado(k=3, tam_paquete=TAM_PAQUETE_DEFECTO):
+    """
+    Compara el LLM puro con una llamada por consulta contra el modo empaquetado.
+
+    Reporta la eficiencia del empaquetado (llamadas, caracteres de prompt, tiempo total,
+    consultas cuya sección no se pudo recuperar) y la precisión por consulta (NDCG@k).
+    """
+    if tam_paquete < 1:
+        raise ValueError(f"tam_paquete debe ser al menos 1 (se recibió {tam_paquete}).")
+
+    load_dotenv()
+    if not os.environ.get("GROQ_API_KEY"):
+        raise ValueError("La variable de entorno GROQ_API_KEY no está configurada.")
+
+    with open('eval/ground_truth.json', 'r', encoding='utf-8') as f:
+        ground_truth_data = json.load(f)
+
+    catalogo_dict = pd.read_csv('src/productos_iqos.csv').to_dict(orient='records')
+    consultas = [item['consulta'] for item in ground_truth_data]
+    total = len(consultas)
+
+    # 1. Una llamada por consulta
+    inicio = time.perf_counter()
+    respuestas_individuales = [recomendar_con_llm(c, productos_candidatos=catalogo_dict) for c in consultas]
+    tiempo_individual = time.perf_counter() - inicio
+    chars_individual = sum(len(construir_prompt(c, catalogo_dict)) for c in consultas)
+
+    # 2. Consultas empaquetadas
+    inicio = time.perf_counter()
+    respuestas_empaquetadas = recomendar_con_llm_empaquetado(
+        consultas, productos_candidatos=[catalogo_dict] * total, tam_paquete=tam_paquete
+    )
+    tiempo_empaquetado = time.perf_counter() - inicio
+    chars_empaquetado = sum(
+        len(construir_prompt_multiple(consultas[i:i + tam_paquete], [catalogo_dict] * len(consultas[i:i + tam_paquete])))
+        for i in range(0, total, tam_paquete)
+    )
+
+    ndcg_individual, ndcg_empaquetado = [], []
+    for item, r_ind, r_emp in zip(ground_truth_data, respuestas_individuales, respuestas_empaquetadas):
+        ground_truth = item['relevancia']
+        ndcg_individual.append(calcular_ndcg_at_k(parsear_recomendaciones_llm(r_ind or "", top_k=k), ground_truth, k))
+        ndcg_empaquetado.append(calcular_ndcg_at_k(parsear_recomendaciones_llm(r_emp or "", top_k=k), ground_truth, k))
+
+    resumen = {
+        "tam_paquete": tam_paquete,
+        "llamadas_individual": total,
+        "llamadas_empaquetado": -(-total // tam_paquete),
+        "chars_prompt_individual": chars_individual,
+        "chars_prompt_empaquetado": chars_empaquetado,
+        "tiempo_individual_s": tiempo_individual,
+        "tiempo_empaquetado_s": tiempo_empaquetado,
+        "secciones_perdidas": sum(1 for r in respuestas_empaquetadas if r is None),
+        f"NDCG@{k}_individual": float(np.mean(ndcg_individual)) if total else 0.0,
+        f"NDCG@{k}_empaquetado": float(np.mean(ndcg_empaquetado)) if total else 0.0,
+    }
+    resumen[f"delta_NDCG@{k}"] = resumen[f"NDCG@{k}_empaquetado"] - resumen[f"NDCG@{k}_individual"]
+
+    print("\n--- Resultados Empaquetado ---")
+    print(f"  - Llamadas: {resumen['llamadas_individual']} -> {resumen['llamadas_empaquetado']} "
+          f"({tam_paquete} consultas por llamada)")
+    print(f"  - Caracteres de prompt: {chars_individual} -> {chars_empaquetado}")
+    print(f"  - Tiempo total: {tiempo_individual:.1f}s -> {tiempo_empaquetado:.1f}s")
+    print(f"  - Consultas sin sección en la respuesta: {resumen['secciones_perdidas']}/{total}")
+    print(f"  - NDCG@{k}: {resumen[f'NDCG@{k}_individual']:.4f} -> {resumen[f'NDCG@{k}_empaquetado']:.4f} "
+          f"(delta {resumen[f'delta_NDCG@{k}']:+.4f})")
+
+    os.makedirs('eval', exist_ok=True)
+    with open('eval/resultados_empaquetado.json', 'w', encoding='utf-8') as f:
+        json.dump(resumen, f, ensure_ascii=False, indent=4)
+
+    return resumen
+
+def evaluar_cache_semantico(k=3, umbral_similitud=UMBRAL_SIMILITUD_CACHE):
+    """
+    Pasa las consultas del ground truth por el híbrido con cache semántico y mide la
+    calidad de los aciertos: para cada consulta respondida desde el cache se calcula también
+    la respuesta fresca y se compara el NDCG@k de ambas contra el ground truth.
+    """
+    load_dotenv()
+    if not os.environ.get("GROQ_API_KEY"):
+        raise ValueError("La variable de entorno GROQ_API_KEY no está configurada.")
+
+    with open('eval/ground_truth.json', 'r', encoding='utf-8') as f:
+        ground_truth_data = json.load(f)
+
+    cache = CacheSemantico(umbral_similitud=umbral_similitud)
+    ndcg_cache, ndcg_fresco, similitudes = [], [], []
+
+    print(f"Evaluando cache semántico (umbral de similitud = {umbral_similitud})...")
+
+    for i, item in enumerate(ground_truth_data):
+        consulta = item['consulta']
+        ground_truth = item['relevancia']
+        print(f"Procesando consulta {i+1}/{len(ground_truth_data)}: \"{consulta[:50]}...\"")
+
+        respuesta, _, detalle = recomendar_hibrido(consulta, cache=cache, plazo_s=None)
+        if respuesta is None or not detalle["cache_hit"]:
+            continue
+
+        respuesta_fresca, _, detalle_fresco = recomendar_hibrido(consulta, plazo_s=None)
+        if respuesta_fresca is None or detalle_fresco["degradado"]:
+            continue
+        similitudes.append(detalle["similitud_cache"])
+        ndcg_cache.append(calcular_ndcg_at_k(parsear_recomendaciones_llm(respuesta, top_k=k), ground_truth, k))
+        ndcg_fresco.append(calcular_ndcg_at_k(parsear_recomendaciones_llm(respuesta_fresca, top_k=k), ground_truth, k))
+
+    resumen = {"umbral_similitud": umbral_similitud, **cache.estadisticas()}
+    resumen["similitud_media_aciertos"] = float(np.mean(similitudes)) if similitudes else 0.0
+    resumen[f"NDCG@{k}_aciertos_cache"] = float(np.mean(ndcg_cache)) if ndcg_cache else 0.0
+    resumen[f"NDCG@{k}_aciertos_fresco"] = float(np.mean(ndcg_fresco)) if ndcg_fresco else 0.0
+    resumen[f"delta_NDCG@{k}_aciertos"] = resumen[f"NDCG@{k}_aciertos_cache"] - resumen[f"NDCG@{k}_aciertos_fresco"]
+
+    print("\n--- Resultados Cache Semántico ---")
+    print(f"  - Aciertos: {resumen['aciertos']}/{resumen['aciertos'] + resumen['fallos']} "
+          f"({resumen['tasa_aciertos']:.1%}), llamadas al LLM evitadas: {resumen['aciertos']}")
+    print(f"  - Similitud media de los aciertos: {resumen['similitud_media_aciertos']:.4f}")
+    print(f"  - NDCG@{k} en aciertos: cache {resumen[f'NDCG@{k}_aciertos_cache']:.4f} vs fresco "
+          f"{resumen[f'NDCG@{k}_aciertos_fresco']:.4f} (delta {resumen[f'delta_NDCG@{k}_aciertos']:+.4f})")
 
     os.makedirs('eval', exist_ok=True)
-    with open('eval/resultados_modelos.json', 'w', encoding='utf-8') as f:
-        json.dump(resultados_evaluacion, f, ensure_ascii=False, indent=4)
+    with open('eval/resultados_cache_semantico.json', 'w', encoding='utf-8') as f:
+        json.dump(resumen, f, ensure_ascii=False, indent=4)
 
-    print("\nEvaluación completada. Resultados guardados en 'eval/resultados_modelos.json'")
+    return resumen
 
 if __name__ == "__main__":
     ejecutar_evaluacion() 
\ No newline at end of file
@@ -4,7 +4,10 @@ from sentence_transformers import SentenceTransformer
 import os
 import logging
 import argparse
-import json
+from typing import Optional
+from huggingface_hub import model_info, snapshot_download
+from artefacto_embeddings import guardar_artefacto, huella_catalogo, EXTENSION
+from indice_bm25 import IndiceBM25, PATH_INDICE_BM25
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,15 +21,44 @@ def validar_dataset(df: pd.DataFrame) -> bool:
         return False
     return True
 
+def resolver_revision(modelo: str) -> Optional[str]:
+    """
+    Devuelve el sha del commit actual del modelo en el Hub, para fijar los pesos exactos.
+
+    Los nombres cortos (p. ej. 'all-MiniLM-L6-v2') se buscan bajo 'sentence-transformers/',
+    igual que hace SentenceTransformer. Sin acceso al Hub (sin red o con HF_HUB_OFFLINE) se usa
+    el sha del snapshot en el cache local; si el modelo tampoco está en cache, o es un
+    directorio local, se devuelve None y el artefacto queda sin revisión fijada.
+    """
+    if os.path.isdir(modelo):
+        logger.warning(f"{modelo} es un directorio local: el artefacto no tendrá revisión fijada.")
+        return None
+    repo_id = modelo if "/" in modelo else f"sentence-transformers/{modelo}"
+    try:
+        return model_info(repo_id).sha
+    except Exception as e:
+        logger.warning(f"No se pudo consultar el Hub para {repo_id} ({e}); se busca el snapshot en cache.")
+
+    try:
+        # Los snapshots del cache viven en .../snapshots/<sha>
+        return os.path.basename(os.path.normpath(snapshot_download(repo_id, local_files_only=True)))
+    except Exception:
+        logger.warning(f"{repo_id} no está en el cache local: el artefacto no tendrá revisión fijada.")
+        return None
+
 def generar_embeddings(
     input_csv: str = "data/iqos_products.csv",
-    output_file: str = "data/embeddings_iqos.npy",
-    output_metadata_file: str = "data/metadata_iqos.json",
+    output_file: str = "data/embeddings_iqos.emb",
     modelo: str = "all-MiniLM-L6-v2",
-    batch_size: int = 32
+    revision: Optional[str] = None,
+    normalizar: bool = True,
+    batch_size: int = 32,
+    output_indice_bm25: Optional[str] = PATH_INDICE_BM25
 ):
     """
-    Genera embeddings para las descripciones de productos IQOS y guarda los metadatos.
+    Genera embeddings para las descripciones de productos IQOS y los guarda en un artefacto
+    versionado junto con el modelo, la dimensión, la normalización y la huella del catálogo.
+    Si `output_indice_bm25` no es None, construye también el índice léxico BM25.
     """
     try:
         if not os.path.exists(input_csv):
@@ -38,24 +70,33 @@ def generar_embeddings(
             return
         
         logger.info(f"Cargando modelo SentenceTransformer: {modelo}")
-        model = SentenceTransformer(modelo)
+        if revision is None:
+            revision = resolver_revision(modelo)
+            logger.info(f"Revisión resuelta para {modelo}: {revision}")
+        model = SentenceTransformer(modelo, revision=revision)
         
         logger.info("Generando embeddings para las descripciones...")
         embeddings = model.encode(
             df['descripcion'].tolist(), 
             batch_size=batch_size,
-            show_progress_bar=True
+            show_progress_bar=True,
+            normalize_embeddings=normalizar
         )
         
-        # Guardar embeddings
-        np.save(output_file, embeddings)
-        logger.info(f"Embeddings guardados en {output_file} (Dimensiones: {embeddings.shape})")
-        
-        # Guardar metadatos
-        metadata = {"model_name": modelo}
-        with open(output_metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=4)
-        logger.info(f"Metadatos guardados en {output_metadata_file}")
+        # Guardar embeddings con su header (modelo, dimensión, huella del catálogo e ids)
+        guardar_artefacto(
+            output_file,
+            embeddings=np.asarray(embeddings, dtype=np.float32),
+            ids=df['id'].tolist(),
+            model_name=modelo,
+            huella=huella_catalogo(df),
+            revision=revision,
+            normalizado=normalizar
+        )
+
+        # Índice léxico BM25 sobre nombre y descripción, con la misma huella de catálogo
+        if output_indice_bm25:
+            IndiceBM25.construir(df).guardar(output_indice_bm25)
         
     except Exception as e:
         logger.error(f"Error al generar embeddings: {e}")
@@ -68,6 +109,17 @@ if __name__ == "__main__":
         default="all-MiniLM-L6-v2",
         help="Nombre del modelo SentenceTransformer a utilizar (ej. 'all-MiniLM-L6-v2' o 'all-mpnet-base-v2')"
     )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        help="Revisión (commit o tag) del modelo en el Hub. Por defecto se fija el sha del último commit."
+    )
+    parser.add_argument(
+        "--sin-normalizar",
+        action="store_true",
+        help="No normalizar los embeddings a norma 1."
+    )
     args = parser.parse_args()
     
     if not os.path.exists('data'):
@@ -75,13 +127,13 @@ if __name__ == "__main__":
 
     # Normalizar el nombre del modelo para usarlo en el nombre del archivo
     model_filename = args.modelo.replace("/", "_")
-    output_path = f"data/embeddings_{model_filename}.npy"
-    metadata_path = f"data/metadata_{model_filename}.json"
+    output_path = f"data/embeddings_{model_filename}{EXTENSION}"
 
     print(f"--- Generando archivos para el modelo: {args.modelo} ---")
     generar_embeddings(
         output_file=output_path,
-        output_metadata_file=metadata_path,
-        modelo=args.modelo
+        modelo=args.modelo,
+        revision=args.revision,
+        normalizar=not args.sin_normalizar
     )
     print("--- Proceso completado ---") #fin
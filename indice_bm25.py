@@ -0,0 +1,144 @@
+import re
+import logging
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from artefacto_embeddings import huella_catalogo
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+PATH_INDICE_BM25 = "data/indice_bm25.npz"
+BM25_K1 = 1.5
+BM25_B = 0.75
+PESO_NOMBRE = 2 # Los tokens del nombre cuentan doble: es donde están los términos exactos de producto
+
+
+def tokenizar(texto: str) -> List[str]:
+    """Pasa a minúsculas, quita tildes y símbolos (™, ®) y separa en palabras."""
+    texto = unicodedata.normalize('NFD', str(texto).lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.findall(r"\w+", texto)
+
+
+class IndiceBM25:
+    """
+    Índice invertido BM25 sobre `nombre` y `descripcion` del catálogo.
+
+    Los pesos BM25 de cada (producto, término) se precalculan en una matriz dispersa CSC
+    de forma (productos, vocabulario): cada columna es la lista de postings de un término,
+    así que puntuar una consulta sólo toca las columnas de sus términos.
+    """
+
+    def __init__(self, pesos: sparse.csc_matrix, vocabulario: List[str], ids: np.ndarray, huella: str):
+        self.pesos = pesos
+        self.vocabulario = list(vocabulario)
+        self.termino_a_columna = {t: i for i, t in enumerate(self.vocabulario)}
+        self.ids = np.asarray(ids)
+        self.huella = huella
+
+    @classmethod
+    def construir(cls, df: pd.DataFrame, k1: float = BM25_K1, b: float = BM25_B) -> "IndiceBM25":
+        """Construye el índice a partir del catálogo de productos."""
+        documentos = [
+            tokenizar(nombre) * PESO_NOMBRE + tokenizar(descripcion)
+            for nombre, descripcion in zip(df['nombre'], df['descripcion'])
+        ]
+
+        vocabulario = sorted({t for doc in documentos for t in doc})
+        termino_a_columna = {t: i for i, t in enumerate(vocabulario)}
+
+        filas, columnas = [], []
+        for fila, doc in enumerate(documentos):
+            for t in doc:
+                filas.append(fila)
+                columnas.append(termino_a_columna[t])
+        # coo -> csr suma los duplicados: queda la frecuencia de cada término en cada producto
+        tf = sparse.coo_matrix(
+            (np.ones(len(filas), dtype=np.float32), (filas, columnas)),
+            shape=(len(documentos), len(vocabulario))
+        ).tocsr()
+
+        largos = np.array([len(doc) for doc in documentos], dtype=np.float32)
+        largo_medio = largos.mean() if len(largos) else 0.0
+        df_terminos = np.bincount(tf.indices, minlength=len(vocabulario))
+        idf = np.log1p((len(documentos) - df_terminos + 0.5) / (df_terminos + 0.5)).astype(np.float32)
+
+        # Peso BM25 = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * largo / largo_medio))
+        norma_por_fila = k1 * (1 - b + b * largos / largo_medio)
+        norma = np.repeat(norma_por_fila, np.diff(tf.indptr))
+        tf.data = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norma)
+
+        logger.info(f"Índice BM25 construido: {len(documentos)} productos, {len(vocabulario)} términos.")
+        return cls(tf.tocsc(), vocabulario, df['id'].to_numpy(), huella_catalogo(df))
+
+    def puntuar(self, consulta: str) -> np.ndarray:
+        """Devuelve el score BM25 de la consulta para cada producto del índice."""
+        columnas = [self.termino_a_columna[t] for t in tokenizar(consulta) if t in self.termino_a_columna]
+        if not columnas:
+            return np.zeros(self.pesos.shape[0], dtype=np.float32)
+        # Términos repetidos en la consulta se suman, igual que en BM25 clásico con qtf lineal
+        return np.asarray(self.pesos[:, columnas].sum(axis=1)).ravel()
+
+    def alinear_con_catalogo(self, df_catalogo: pd.DataFrame, huella: Optional[str] = None) -> "IndiceBM25":
+        """
+        Valida la huella (id, nombre y descripción) contra el catálogo y reordena las filas
+        para seguir su orden. `huella` evita recalcularla si quien llama ya la tiene.
+        """
+        if huella is None:
+            huella = huella_catalogo(df_catalogo)
+        if huella != self.huella:
+            raise ValueError(
+                "El catálogo no coincide con el usado para construir el índice BM25. "
+                "Regeneralo con generar_embeddings_iqos.py."
+            )
+        ids_catalogo = df_catalogo['id'].to_numpy()
+        if np.array_equal(ids_catalogo, self.ids):
+            return self
+
+        posicion_por_id = {int(i): pos for pos, i in enumerate(self.ids)}
+        posiciones = [posicion_por_id[int(i)] for i in ids_catalogo]
+        return IndiceBM25(self.pesos[posiciones], self.vocabulario, ids_catalogo, self.huella)
+
+    def guardar(self, path: str = PATH_INDICE_BM25):
+        """Guarda el índice en un único .npz (sin pickle)."""
+        np.savez_compressed(
+            path,
+            data=self.pesos.data,
+            indices=self.pesos.indices,
+            indptr=self.pesos.indptr,
+            shape=np.array(self.pesos.shape),
+            vocabulario=np.array(self.vocabulario, dtype=str),
+            ids=self.ids,
+            huella=np.array(self.huella)
+        )
+        logger.info(f"Índice BM25 guardado en {path}")
+
+    @classmethod
+    def cargar(
+        cls,
+        path: str = PATH_INDICE_BM25,
+        df_catalogo: Optional[pd.DataFrame] = None,
+        huella: Optional[str] = None
+    ) -> "IndiceBM25":
+        """Carga el índice y, si se pasa el catálogo, lo valida y alinea con él."""
+        with np.load(path, allow_pickle=False) as z:
+            pesos = sparse.csc_matrix((z['data'], z['indices'], z['indptr']), shape=tuple(z['shape']))
+            indice = cls(pesos, z['vocabulario'].tolist(), z['ids'], str(z['huella']))
+        if df_catalogo is not None:
+            indice = indice.alinear_con_catalogo(df_catalogo, huella=huella)
+        return indice
+
+
+def rangos_descendentes(scores: np.ndarray) -> np.ndarray:
+    """Devuelve la posición (1 = mejor) de cada elemento al ordenar los scores de mayor a menor."""
+    orden = np.argsort(-scores, kind='stable')
+    rangos = np.empty(len(scores), dtype=np.int64)
+    rangos[orden] = np.arange(1, len(scores) + 1)
+    return rangos
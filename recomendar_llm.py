@@ -1,10 +1,17 @@
 # recomendar_llm.py
 
 import os
+import re
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
 import logging
+from cache_semantico import CacheSemantico, version_candidatos
 
 # --- Cargar variables de entorno desde archivo .env ---
 # Esto busca un archivo .env en el directorio raíz del proyecto
@@ -16,26 +23,50 @@ logger = logging.getLogger(__name__)
 
 # ---------- CONFIGURACIÓN ----------
 MODEL_NAME = "llama3-8b-8192"
+PATH_CATALOGO_CSV = "src/productos_iqos.csv"
+TAM_PAQUETE_DEFECTO = 5 # Consultas por llamada en modo empaquetado
+MARCADOR_RESPUESTA = "=== RESPUESTA CONSULTA"
+
+# Plazo y solicitudes de cobertura (hedging)
+PERCENTIL_COBERTURA = 95 # Se duplica la solicitud si tarda más que este percentil de latencia
+RETRASO_COBERTURA_DEFECTO_S = 2.0 # Retraso usado mientras no hay suficientes latencias medidas
+MIN_MUESTRAS_LATENCIA = 20
+VENTANA_LATENCIAS = 200 # Últimas latencias consideradas para el percentil
+MAX_FALLOS_CIRCUITO = 5 # Fallos consecutivos que abren el circuito
+ENFRIAMIENTO_CIRCUITO_S = 30.0 # Tiempo sin llamar al LLM con el circuito abierto
+FRACCION_TIMEOUT_CENSURADO = 0.95 # Un fallo que tardó al menos esta fracción del timeout se toma como timeout
+
+def instruccion_rol() -> str:
+    """Instrucción de rol (persona), compartida por el prompt individual y el empaquetado."""
+    return "Actúa como un experto vendedor de IQOS y asistente de compras personal. Tu objetivo es ayudar a un usuario a encontrar el producto perfecto para él.\n\n"
+
+def formatear_producto(producto: Dict) -> str:
+    """Línea con la que cada producto aparece en los prompts."""
+    return f"- Nombre: {producto['nombre']}, Descripción: {producto['descripcion']}\n"
 
 def construir_prompt(consulta_usuario: str, productos: List[Dict]) -> str:
     """Construye el prompt para el LLM con técnicas de Prompt Engineering."""
     
     # 1. Instrucción de Rol (Persona)
-    prompt = "Actúa como un experto vendedor de IQOS y asistente de compras personal. Tu objetivo es ayudar a un usuario a encontrar el producto perfecto para él.\n\n"
+    prompt = instruccion_rol()
     
     # 2. Contexto y Tarea
     prompt += f"Un usuario ha realizado la siguiente consulta: '{consulta_usuario}'.\n\n"
     prompt += "A continuación, se presenta una lista de productos disponibles con sus descripciones:\n"
     for p in productos:
-        prompt += f"- Nombre: {p['nombre']}, Descripción: {p['descripcion']}\n"
+        prompt += formatear_producto(p)
     
     # 3. Instrucción de Salida y Razonamiento (Chain-of-Thought)
     prompt += "\n**Instrucciones:**\n1.  **Analiza la consulta:** Lee atentamente la consulta del usuario para entender sus preferencias, necesidades y cualquier restricción.\n2.  **Evalúa los productos:** Revisa la siguiente lista de productos y compáralos con la consulta del usuario.\n3.  **Razonamiento paso a paso:** Antes de dar la recomendación final, explica brevemente tu proceso de pensamiento.\n4.  **Recomendación final:** Ofrece una recomendación clara y concisa.\n5.  **Formato de Salida Obligatorio:** Al final de toda tu respuesta, incluye una sección que comience EXACTAMENTE con la línea \"PRODUCTOS RECOMENDADOS:\" seguida de una lista numerada de los 3 productos principales que recomendaste.\n\n**Consulta del usuario:**\n\"{consulta_usuario}\"\n\n**Lista de productos:**\n"
     
     return prompt
 
-def obtener_recomendaciones_llm(prompt: str) -> Optional[str]:
-    """Llama a la API de Groq para obtener la respuesta del LLM."""
+def obtener_recomendaciones_llm(prompt: str, timeout: Optional[float] = None) -> Optional[str]:
+    """
+    Llama a la API de Groq para obtener la respuesta del LLM.
+
+    Si se indica `timeout` (segundos), la llamada se corta al vencer y no se reintenta.
+    """
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         logger.warning("La variable de entorno GROQ_API_KEY no se encontró.")
@@ -44,9 +75,11 @@ def obtener_recomendaciones_llm(prompt: str) -> Optional[str]:
 
     try:
         from openai import OpenAI
+        opciones_cliente = {"timeout": timeout, "max_retries": 0} if timeout is not None else {}
         client = OpenAI(
             api_key=api_key,
             base_url="https://api.groq.com/openai/v1",
+            **opciones_cliente
         )
         chat_completion = client.chat.completions.create(
             messages=[{"role": "user", "content": prompt}],
@@ -62,31 +95,302 @@ def obtener_recomendaciones_llm(prompt: str) -> Optional[str]:
         print(f"Error al contactar la API de Groq: {e}")
         return None
 
-def recomendar_con_llm(consulta_usuario: str, productos_candidatos: Optional[List[Dict]] = None):
+# ---------- PLAZO, SOLICITUDES DE COBERTURA Y CIRCUIT BREAKER ----------
+
+class CircuitoLLM:
+    """
+    Circuit breaker para el LLM.
+
+    Tras `max_fallos` fallos consecutivos (errores o plazos vencidos) el circuito se abre y no
+    se llama al LLM durante `enfriamiento_s` segundos. Pasado ese tiempo se deja pasar una
+    llamada de prueba: si sale bien el circuito se cierra, si falla vuelve a abrirse.
+    """
+
+    def __init__(self, max_fallos: int = MAX_FALLOS_CIRCUITO, enfriamiento_s: float = ENFRIAMIENTO_CIRCUITO_S):
+        self.max_fallos = max_fallos
+        self.enfriamiento_s = enfriamiento_s
+        self.fallos_consecutivos = 0
+        self.abierto_desde: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def permite_llamada(self) -> bool:
+        with self._lock:
+            if self.abierto_desde is None:
+                return True
+            if time.monotonic() - self.abierto_desde >= self.enfriamiento_s:
+                # Semiabierto: pasa esta llamada de prueba y las demás esperan otro enfriamiento
+                self.abierto_desde = time.monotonic()
+                return True
+            return False
+
+    def registrar_exito(self):
+        with self._lock:
+            self.fallos_consecutivos = 0
+            self.abierto_desde = None
+
+    def registrar_fallo(self):
+        with self._lock:
+            self.fallos_consecutivos += 1
+            if self.fallos_consecutivos >= self.max_fallos:
+                if self.abierto_desde is None:
+                    logger.warning(f"Circuito del LLM abierto tras {self.fallos_consecutivos} fallos consecutivos.")
+                self.abierto_desde = time.monotonic()
+
+circuito_llm = CircuitoLLM()
+_latencias_llm = deque(maxlen=VENTANA_LATENCIAS)
+
+def calcular_retraso_cobertura(percentil: float = PERCENTIL_COBERTURA) -> float:
+    """Retraso antes de enviar la solicitud de cobertura: percentil de las latencias recientes."""
+    if len(_latencias_llm) < MIN_MUESTRAS_LATENCIA:
+        return RETRASO_COBERTURA_DEFECTO_S
+    return float(np.percentile(list(_latencias_llm), percentil))
+
+def _llamada_medida(prompt: str, timeout: float) -> Optional[str]:
+    """
+    Llama al LLM y registra la latencia para calcular el retraso de cobertura.
+
+    Las respuestas exitosas registran su latencia real. Las que se cortan por timeout se
+    registran como muestra censurada en `timeout` (la latencia real fue al menos esa): si se
+    descartaran, el percentil saldría sesgado hacia abajo justo en la cola que se quiere medir.
+    Los errores rápidos (p. ej. 429) no dicen nada de la latencia y no se registran.
+    """
+    inicio = time.monotonic()
+    respuesta = obtener_recomendaciones_llm(prompt, timeout=timeout)
+    transcurrido = time.monotonic() - inicio
+    if respuesta:
+        _latencias_llm.append(transcurrido)
+    elif transcurrido >= timeout * FRACCION_TIMEOUT_CENSURADO:
+        _latencias_llm.append(timeout)
+    return respuesta
+
+def obtener_recomendaciones_llm_con_plazo(
+    prompt: str,
+    plazo_s: float,
+    percentil_cobertura: float = PERCENTIL_COBERTURA,
+    detalle: Optional[Dict] = None
+) -> Optional[str]:
+    """
+    Llama al LLM con un plazo máximo, enviando una solicitud duplicada de cobertura.
+
+    Si la primera solicitud sigue pendiente al llegar al percentil `percentil_cobertura` de las
+    latencias recientes, se envía una segunda idéntica y se usa la primera que responda. Si
+    falla antes de ese momento no se envía la cobertura: el intento termina y cuenta como fallo
+    para el circuito. Devuelve None si el plazo vence, si las solicitudes fallan o si el
+    circuito está abierto.
+
+    Si se pasa `detalle`, se completa con `llm_invocado` (si salió alguna solicitud),
+    `solicitudes_llm` (1 o 2) y `circuito_abierto`.
+    """
+    if detalle is None:
+        detalle = {}
+    detalle.update({"llm_invocado": False, "solicitudes_llm": 0, "circuito_abierto": False})
+
+    if not circuito_llm.permite_llamada():
+        logger.warning("Circuito del LLM abierto: se omite la llamada.")
+        detalle["circuito_abierto"] = True
+        return None
+
+    inicio = time.monotonic()
+    limite = inicio + plazo_s
+    momento_cobertura = inicio + min(calcular_retraso_cobertura(percentil_cobertura), plazo_s)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        pendientes = {executor.submit(_llamada_medida, prompt, plazo_s)}
+        detalle["llm_invocado"] = True
+        detalle["solicitudes_llm"] = 1
+        cobertura_enviada = False
+        while True:
+            ahora = time.monotonic()
+            if ahora >= limite:
+                logger.warning(f"El LLM no respondió dentro del plazo de {plazo_s:.2f}s.")
+                break
+            espera = limite - ahora if cobertura_enviada else max(0.0, momento_cobertura - ahora)
+            hechos, pendientes = wait(pendientes, timeout=espera, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                respuesta = futuro.result()
+                if respuesta:
+                    circuito_llm.registrar_exito()
+                    return respuesta
+            if not pendientes:
+                # Todas las solicitudes enviadas fallaron: un fallo rápido (429, sin clave) no se
+                # reintenta, porque duplicaría el tráfico justo cuando el proveedor limita
+                break
+            if not cobertura_enviada and time.monotonic() >= momento_cobertura:
+                restante = limite - time.monotonic()
+                if restante > 0:
+                    logger.info(f"Enviando solicitud de cobertura al LLM ({time.monotonic() - inicio:.2f}s).")
+                    pendientes.add(executor.submit(_llamada_medida, prompt, restante))
+                    detalle["solicitudes_llm"] = 2
+                    cobertura_enviada = True
+    finally:
+        # Las solicitudes en curso terminan solas por su propio timeout; no se las espera
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    circuito_llm.registrar_fallo()
+    return None
+
+def cargar_catalogo(path_csv: str = PATH_CATALOGO_CSV) -> Optional[List[Dict]]:
+    """Carga todos los productos del catálogo como lista de diccionarios."""
+    try:
+        df_productos = pd.read_csv(path_csv)
+        return df_productos.to_dict(orient='records')
+    except FileNotFoundError:
+        logger.error(f"No se encontró el archivo '{path_csv}'.")
+        print("Error: El archivo de productos no fue encontrado.")
+        return None
+
+def recomendar_con_llm(
+    consulta_usuario: str,
+    productos_candidatos: Optional[List[Dict]] = None,
+    plazo_s: Optional[float] = None,
+    cache: Optional[CacheSemantico] = None,
+    detalle: Optional[Dict] = None
+):
     """
     Obtiene recomendaciones de productos IQOS utilizando un LLM.
     Puede operar sobre todos los productos o sobre una lista de candidatos pre-filtrada.
+    Con `plazo_s`, la llamada usa plazo, solicitud de cobertura y circuit breaker
+    (ver `obtener_recomendaciones_llm_con_plazo`) y devuelve None si no llega a tiempo.
+    Con `cache`, una consulta equivalente ya respondida sobre el mismo conjunto de productos
+    se contesta sin llamar al LLM.
+    Si se pasa `detalle`, se completa con `llm_invocado`: si de verdad salió una solicitud
+    (no la hay con el circuito abierto ni con un acierto del cache).
     """
-    productos_a_considerar = []
+    if detalle is None:
+        detalle = {}
+    detalle["llm_invocado"] = False
     if productos_candidatos is None:
         logger.info("No se proveyeron candidatos, cargando todos los productos del catálogo...")
-    try:
-            df_productos = pd.read_csv("src/productos_iqos.csv")
-            productos_a_considerar = df_productos.to_dict(orient='records')
-    except FileNotFoundError:
-            logger.error("No se encontró el archivo 'src/productos_iqos.csv'.")
-            print("Error: El archivo de productos no fue encontrado.")
+        productos_a_considerar = cargar_catalogo()
+        if productos_a_considerar is None:
             return None
     else:
         logger.info(f"Recibidos {len(productos_candidatos)} candidatos para re-ranking por el LLM.")
         productos_a_considerar = productos_candidatos
 
+    if cache is not None:
+        version = version_candidatos(productos_a_considerar)
+        embedding_consulta = cache.codificar(consulta_usuario)
+        acierto = cache.buscar(consulta_usuario, version, embedding=embedding_consulta)
+        if acierto is not None:
+            logger.info(f"Respuesta desde el cache semántico (similitud {acierto['similitud']:.3f}).")
+            return acierto["respuesta"]
+
     prompt = construir_prompt(consulta_usuario, productos_a_considerar)
-    respuesta = obtener_recomendaciones_llm(prompt)
+    if plazo_s is not None:
+        respuesta = obtener_recomendaciones_llm_con_plazo(prompt, plazo_s, detalle=detalle)
+    else:
+        detalle["llm_invocado"] = True
+        respuesta = obtener_recomendaciones_llm(prompt)
 
     if respuesta:
+        if cache is not None:
+            cache.guardar(consulta_usuario, version, respuesta, embedding=embedding_consulta)
         return respuesta
 
+# ---------- EMPAQUETADO DE VARIAS CONSULTAS POR LLAMADA ----------
+
+def construir_prompt_multiple(consultas: List[str], productos_por_consulta: List[List[Dict]]) -> str:
+    """
+    Construye un único prompt con varias consultas y sus candidatos.
+
+    El rol y las instrucciones se escriben una sola vez. Si todas las consultas comparten la
+    misma lista de productos (p. ej. el catálogo completo), la lista también se escribe una vez.
+    Se pide una sección por consulta con un marcador fijo para poder separar la respuesta.
+    """
+    prompt = instruccion_rol()
+    prompt += f"Vas a recibir {len(consultas)} consultas independientes. Respóndelas por separado: lo que dice una consulta no aplica a las demás.\n\n"
+
+    nombres_por_consulta = [[p['nombre'] for p in productos] for productos in productos_por_consulta]
+    lista_comun = all(nombres == nombres_por_consulta[0] for nombres in nombres_por_consulta)
+
+    if lista_comun:
+        prompt += "**Lista de productos (común a todas las consultas):**\n"
+        for p in productos_por_consulta[0]:
+            prompt += formatear_producto(p)
+        prompt += "\n"
+
+    for i, (consulta, productos) in enumerate(zip(consultas, productos_por_consulta), start=1):
+        prompt += f"### CONSULTA {i}\n\"{consulta}\"\n"
+        if not lista_comun:
+            prompt += "Productos candidatos:\n"
+            for p in productos:
+                prompt += formatear_producto(p)
+        prompt += "\n"
+
+    prompt += (
+        "**Instrucciones:**\n"
+        "1.  Para cada consulta, analiza las preferencias y restricciones del usuario y compáralas con los productos.\n"
+        "2.  Explica brevemente tu razonamiento (2 o 3 frases como máximo por consulta).\n"
+        "3.  **Formato de Salida Obligatorio:** Para cada consulta, en orden, escribe una sección que comience "
+        f"EXACTAMENTE con la línea \"{MARCADOR_RESPUESTA} <número>\" (p. ej. \"{MARCADOR_RESPUESTA} 1\"), "
+        "seguida de tu razonamiento y de una línea \"PRODUCTOS RECOMENDADOS:\" con una lista numerada "
+        "de los 3 productos principales para esa consulta, usando los nombres exactos de la lista.\n"
+    )
+    return prompt
+
+def separar_respuestas_multiples(respuesta: Optional[str], num_consultas: int) -> List[Optional[str]]:
+    """
+    Divide la respuesta empaquetada en una sección por consulta.
+
+    Cada sección queda con el mismo formato que la respuesta a una consulta individual,
+    así que se puede pasar directamente a `parsear_recomendaciones_llm`. Las consultas cuya
+    sección falta o no tiene contenido quedan en None.
+    """
+    secciones: List[Optional[str]] = [None] * num_consultas
+    if not respuesta:
+        return secciones
+
+    patron = re.compile(rf"^\W*{re.escape(MARCADOR_RESPUESTA)}\s*(\d+)\W*$", re.MULTILINE | re.IGNORECASE)
+    marcadores = list(patron.finditer(respuesta))
+    for j, marcador in enumerate(marcadores):
+        numero = int(marcador.group(1))
+        fin = marcadores[j + 1].start() if j + 1 < len(marcadores) else len(respuesta)
+        contenido = respuesta[marcador.end():fin].strip()
+        if 1 <= numero <= num_consultas and contenido and secciones[numero - 1] is None:
+            secciones[numero - 1] = contenido
+    return secciones
+
+def recomendar_con_llm_empaquetado(
+    consultas: List[str],
+    productos_candidatos: Optional[List[List[Dict]]] = None,
+    tam_paquete: int = TAM_PAQUETE_DEFECTO
+) -> List[Optional[str]]:
+    """
+    Igual que `recomendar_con_llm`, pero agrupa hasta `tam_paquete` consultas por llamada.
+
+    Args:
+        consultas: Las consultas de los usuarios.
+        productos_candidatos: (Opcional) Una lista de candidatos por consulta. Si es None,
+            todas las consultas se evalúan contra el catálogo completo.
+        tam_paquete: Cantidad máxima de consultas por llamada al LLM.
+
+    Returns:
+        Una respuesta por consulta (None si la sección de esa consulta no pudo recuperarse).
+    """
+    if tam_paquete < 1:
+        raise ValueError(f"tam_paquete debe ser al menos 1 (se recibió {tam_paquete}).")
+    if productos_candidatos is None:
+        catalogo = cargar_catalogo()
+        if catalogo is None:
+            return [None] * len(consultas)
+        productos_candidatos = [catalogo] * len(consultas)
+    if len(productos_candidatos) != len(consultas):
+        raise ValueError("Debe haber una lista de candidatos por consulta.")
+
+    respuestas: List[Optional[str]] = []
+    for inicio in range(0, len(consultas), tam_paquete):
+        paquete = consultas[inicio:inicio + tam_paquete]
+        logger.info(f"Enviando paquete de {len(paquete)} consultas al LLM ({inicio + 1}-{inicio + len(paquete)}).")
+        prompt = construir_prompt_multiple(paquete, productos_candidatos[inicio:inicio + tam_paquete])
+        secciones = separar_respuestas_multiples(obtener_recomendaciones_llm(prompt), len(paquete))
+        faltantes = sum(1 for s in secciones if s is None)
+        if faltantes:
+            logger.warning(f"{faltantes} de {len(paquete)} consultas sin sección en la respuesta empaquetada.")
+        respuestas.extend(secciones)
+    return respuestas
+
 if __name__ == '__main__':
     print("--- Ejecutando recomendador LLM (Llama 3 con Groq) de forma individual ---")
     
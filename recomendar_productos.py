@@ -5,7 +5,10 @@ from sklearn.metrics.pairwise import cosine_similarity
 import logging
 from typing import Optional, List, Tuple, Dict
 from tabulate import tabulate
+import os
 import json
+from artefacto_embeddings import cargar_artefacto, huella_catalogo, EXTENSION
+from indice_bm25 import IndiceBM25, PATH_INDICE_BM25, rangos_descendentes
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,18 +17,70 @@ logger = logging.getLogger(__name__)
 # --- Constantes ---
 PATH_PRODUCTOS_CSV = "data/iqos_products.csv"
 MODELO_DEFECTO = 'all-MiniLM-L6-v2'
-PATH_EMBEDDINGS_DEFECTO = f"data/embeddings_{MODELO_DEFECTO}.npy"
+PATH_EMBEDDINGS_DEFECTO = f"data/embeddings_{MODELO_DEFECTO}{EXTENSION}"
+MODOS_RECUPERACION = ("denso", "lexico", "hibrido")
+RRF_K = 60 # Constante estándar de Reciprocal Rank Fusion
 
+# Catálogo, embeddings e índice BM25 ya leídos, validados y alineados, por (ruta, fecha de
+# modificación) de cada archivo involucrado: la huella del catálogo y el reordenamiento por id
+# cuestan más que la consulta misma, así que se hacen una vez por versión de los archivos.
+_catalogos: Dict[Tuple[str, float], Tuple[pd.DataFrame, str]] = {}
+_embeddings_alineados: Dict[Tuple, Tuple[np.ndarray, Optional[Dict]]] = {}
+_indices_bm25: Dict[Tuple, IndiceBM25] = {}
 
-def cargar_datos(path_productos: str, path_embeddings: str) -> tuple:
-    """Carga los datos de productos y los embeddings desde los archivos."""
-    try:
+
+def clave_archivo(path: str) -> Tuple[str, float]:
+    """(ruta, fecha de modificación): cambia si el archivo se regenera."""
+    return (path, os.path.getmtime(path))
+
+def cargar_catalogo(path_productos: str) -> Tuple[pd.DataFrame, str]:
+    """Lee el catálogo y calcula su huella, sólo si el CSV cambió desde la última lectura."""
+    clave = clave_archivo(path_productos)
+    if clave not in _catalogos:
+        _catalogos.clear()
         df = pd.read_csv(path_productos)
-        embeddings = np.load(path_embeddings)
-        return df, embeddings
+        _catalogos[clave] = (df, huella_catalogo(df))
+    return _catalogos[clave]
+
+def cargar_datos(path_productos: str, path_embeddings: str, cargar_embeddings: bool = True) -> tuple:
+    """
+    Carga los datos de productos y los embeddings desde los archivos.
+
+    Los artefactos versionados (.emb) se validan contra el catálogo y se devuelven alineados
+    por id junto con su header; un .npy plano se acepta por compatibilidad, sin header.
+    Se devuelve también la huella del catálogo para reutilizarla. La validación y el
+    alineamiento se hacen una vez por versión del CSV y del artefacto, no en cada consulta.
+    Con `cargar_embeddings=False` (recuperación sólo léxica) no se abre el artefacto.
+    """
+    try:
+        df, huella = cargar_catalogo(path_productos)
+        if not cargar_embeddings:
+            return df, None, None, huella
+
+        clave = (clave_archivo(path_productos), clave_archivo(path_embeddings))
+        if clave not in _embeddings_alineados:
+            _embeddings_alineados.clear()
+            if path_embeddings.endswith(EXTENSION):
+                _embeddings_alineados[clave] = cargar_artefacto(path_embeddings, df_catalogo=df, huella=huella)
+            else:
+                logger.warning(f"{path_embeddings} no tiene header: no se puede verificar que corresponda al catálogo.")
+                _embeddings_alineados[clave] = (np.load(path_embeddings), None)
+        embeddings, header = _embeddings_alineados[clave]
+        return df, embeddings, header, huella
     except FileNotFoundError as e:
         logger.error(f"Error al cargar datos: {e}. Asegúrate de que los archivos existen.")
-        return None, None
+        return None, None, None, None
+
+def cargar_indice_bm25(path_indice: str, path_productos: str, df_catalogo: pd.DataFrame, huella: str) -> IndiceBM25:
+    """
+    Devuelve el índice BM25 validado y alineado con el catálogo. El .npz se lee, se valida
+    y se reordena sólo cuando cambia él o el CSV del catálogo.
+    """
+    clave = (clave_archivo(path_indice), clave_archivo(path_productos))
+    if clave not in _indices_bm25:
+        _indices_bm25.clear()
+        _indices_bm25[clave] = IndiceBM25.cargar(path_indice, df_catalogo=df_catalogo, huella=huella)
+    return _indices_bm25[clave]
 
 def calcular_diversidad(recomendaciones_df, embeddings_originales):
     """Calcula la diversidad como la distancia promedio entre los ítems recomendados."""
@@ -50,13 +105,37 @@ def calcular_novedad(recomendaciones_df, historial_usuario):
     novedad = len(ids_recomendados - ids_historial) / len(ids_recomendados)
     return novedad
 
+def similitud_densa(embedding_consulta: np.ndarray, embeddings: np.ndarray, normalizado: bool) -> np.ndarray:
+    """Similitud coseno entre la consulta y cada fila de `embeddings`."""
+    if normalizado:
+        # Con vectores de norma 1 la similitud coseno es directamente el producto punto
+        return (embeddings @ embedding_consulta[0]).astype(float)
+    return cosine_similarity(embedding_consulta, embeddings).flatten()
+
+def fusionar_rrf(scores_denso: np.ndarray, scores_lexico: np.ndarray, k: int = RRF_K) -> np.ndarray:
+    """
+    Reciprocal Rank Fusion: suma 1 / (k + rango) de cada lista.
+
+    Los productos sin score denso (NaN, podados) o sin ningún término de la consulta
+    (score BM25 = 0) no aportan desde esa lista.
+    """
+    fusion = np.zeros(len(scores_lexico))
+    con_denso = ~np.isnan(scores_denso)
+    fusion[con_denso] += 1.0 / (k + rangos_descendentes(scores_denso[con_denso]))
+    con_lexico = scores_lexico > 0
+    fusion[con_lexico] += 1.0 / (k + rangos_descendentes(scores_lexico[con_lexico]))
+    return fusion
+
 def recomendar_productos(
     consulta: str,
     top_k: int = 3,
     path_productos: str = PATH_PRODUCTOS_CSV,
     path_embeddings: str = PATH_EMBEDDINGS_DEFECTO,
     path_metadata: Optional[str] = None,
-    categoria: Optional[str] = None
+    categoria: Optional[str] = None,
+    modo: str = "denso",
+    path_indice_bm25: str = PATH_INDICE_BM25,
+    max_candidatos_densos: Optional[int] = None
 ) -> Tuple[pd.DataFrame, Dict]:
     """
     Genera recomendaciones de productos basadas en una consulta de usuario.
@@ -65,34 +144,28 @@ def recomendar_productos(
         consulta: La consulta del usuario en lenguaje natural.
         top_k: El número de recomendaciones a devolver.
         path_productos: Ruta al archivo CSV de productos.
-        path_embeddings: Ruta al archivo .npy de embeddings.
+        path_embeddings: Ruta al artefacto de embeddings (.emb) o a un .npy plano.
         path_metadata: (Opcional) Ruta al archivo JSON de metadatos del modelo de embedding.
+            Sólo se usa con .npy planos; el artefacto .emb ya incluye el modelo.
         categoria: (Opcional) La categoría de productos a filtrar.
+        modo: "denso" (SBERT), "lexico" (BM25) o "hibrido" (fusión RRF de ambos).
+        path_indice_bm25: Ruta al índice BM25 (modos "lexico" e "hibrido").
+        max_candidatos_densos: (Opcional, modo "hibrido") Si el catálogo es más grande, la
+            similitud densa sólo se calcula sobre los mejores candidatos de BM25.
     
     Returns:
         Un DataFrame con los productos recomendados y un diccionario con métricas.
     """
-    df, embeddings = cargar_datos(path_productos, path_embeddings)
+    if modo not in MODOS_RECUPERACION:
+        raise ValueError(f"Modo '{modo}' no soportado. Opciones: {MODOS_RECUPERACION}")
+
+    df, embeddings, header, huella = cargar_datos(
+        path_productos, path_embeddings, cargar_embeddings=(modo != "lexico")
+    )
     if df is None:
         return pd.DataFrame(), {}
 
-    # 1. Cargar el modelo de embedding
-    model_name = MODELO_DEFECTO
-    if path_metadata:
-        try:
-            with open(path_metadata, 'r') as f:
-                metadata = json.load(f)
-                model_name = metadata.get('model_name', MODELO_DEFECTO)
-        except (FileNotFoundError, json.JSONDecodeError):
-            logger.warning(f"No se pudo leer el archivo de metadatos en {path_metadata}. Usando modelo por defecto.")
-    
-    logger.info(f"Cargando modelo de embedding: {model_name}")
-    modelo_transformer = SentenceTransformer(model_name)
-        
-    # 2. Generar embedding para la consulta
-    embedding_consulta = modelo_transformer.encode([consulta], show_progress_bar=False)
-        
-    # 3. Filtrar por categoría si se especifica
+    # 1. Filtrar por categoría si se especifica
     df_filtrado = df
     indices_filtrados = df.index
     if categoria:
@@ -102,11 +175,76 @@ def recomendar_productos(
     if df_filtrado.empty:
         logger.warning(f"No se encontraron productos para la categoría '{categoria}'.")
         return pd.DataFrame(), {}
+
+    # 2. Etapa léxica (BM25) sobre el índice invertido
+    scores_lexico = None
+    if modo in ("lexico", "hibrido"):
+        try:
+            indice = cargar_indice_bm25(path_indice_bm25, path_productos, df, huella)
+        except FileNotFoundError as e:
+            logger.error(f"Error al cargar el índice BM25: {e}. Generalo con generar_embeddings_iqos.py.")
+            return pd.DataFrame(), {}
+        scores_lexico = indice.puntuar(consulta)[indices_filtrados]
+        if modo == "lexico" and not scores_lexico.any():
+            logger.warning("Ningún término de la consulta aparece en el catálogo: sin resultados léxicos.")
+            return pd.DataFrame(), {}
+
+    # 3. Etapa densa (SBERT), opcionalmente podada con los candidatos léxicos
+    model_name = "BM25"
+    if modo in ("denso", "hibrido"):
+        model_name = MODELO_DEFECTO
+        revision = None
+        normalizado = False
+        if header is not None:
+            model_name = header['model_name']
+            revision = header.get('model_revision')
+            if revision is None:
+                logger.warning(f"{path_embeddings} no fija la revisión del modelo: se usará la última del Hub.")
+            normalizado = header.get('normalizado', False)
+        elif path_metadata:
+            try:
+                with open(path_metadata, 'r') as f:
+                    metadata = json.load(f)
+                    model_name = metadata.get('model_name', MODELO_DEFECTO)
+            except (FileNotFoundError, json.JSONDecodeError):
+                logger.warning(f"No se pudo leer el archivo de metadatos en {path_metadata}. Usando modelo por defecto.")
         
-    embeddings_filtrados = embeddings[indices_filtrados]
-        
-    # 4. Calcular similitud y obtener los mejores K
-    similitudes = cosine_similarity(embedding_consulta, embeddings_filtrados).flatten()
+        logger.info(f"Cargando modelo de embedding: {model_name}")
+        modelo_transformer = SentenceTransformer(model_name, revision=revision)
+        if header is not None and modelo_transformer.get_sentence_embedding_dimension() != header['dim']:
+            raise ValueError(
+                f"El modelo {model_name} produce vectores de dimensión "
+                f"{modelo_transformer.get_sentence_embedding_dimension()}, pero el artefacto tiene {header['dim']}."
+            )
+            
+        embedding_consulta = modelo_transformer.encode(
+            [consulta], show_progress_bar=False, normalize_embeddings=normalizado
+        )
+
+        posiciones_densas = np.arange(len(indices_filtrados))
+        if (modo == "hibrido" and max_candidatos_densos
+                and len(indices_filtrados) > max_candidatos_densos
+                and np.count_nonzero(scores_lexico) >= top_k):
+            posiciones_densas = np.argpartition(-scores_lexico, max_candidatos_densos - 1)[:max_candidatos_densos]
+            logger.info(f"Poda léxica: similitud densa sobre {len(posiciones_densas)} de {len(indices_filtrados)} productos.")
+
+        scores_denso = np.full(len(indices_filtrados), np.nan)
+        scores_denso[posiciones_densas] = similitud_densa(
+            embedding_consulta, embeddings[indices_filtrados[posiciones_densas]], normalizado
+        )
+
+    # 4. Combinar scores y obtener los mejores K
+    if modo == "denso":
+        similitudes = scores_denso
+    elif modo == "lexico":
+        # Sólo compiten los productos que comparten algún término con la consulta
+        similitudes = np.where(scores_lexico > 0, scores_lexico, np.nan).astype(float)
+        top_k = min(top_k, int(np.count_nonzero(scores_lexico)))
+    else:
+        similitudes = fusionar_rrf(scores_denso, scores_lexico)
+        model_name = f"{model_name} + BM25 (RRF)"
+
+    similitudes = np.nan_to_num(similitudes, nan=-np.inf)
     indices_top_local = np.argsort(similitudes)[-top_k:][::-1]
     indices_top_global = indices_filtrados[indices_top_local]
 
@@ -116,10 +254,12 @@ def recomendar_productos(
     # 5. Calcular métricas
     metricas = {
         "similitud_promedio": recomendaciones['score'].mean(),
-        "diversidad": calcular_diversidad(recomendaciones, embeddings),
         "novedad": calcular_novedad(recomendaciones, None), # Historial no implementado aún
         "model_used": model_name
     }
+    if embeddings is not None:
+        # La diversidad se mide en el espacio de embeddings: no aplica a la recuperación léxica
+        metricas["diversidad"] = calcular_diversidad(recomendaciones, embeddings)
 
     return recomendaciones, metricas
 
@@ -134,7 +274,8 @@ def mostrar_recomendaciones(df_recomendaciones: pd.DataFrame, metricas: dict):
     print("\n--- Métricas de la Recomendación ---")
     print(f"Modelo de Embedding: {metricas.get('model_used', 'No especificado')}")
     print(f"Similitud Promedio: {metricas.get('similitud_promedio', 0):.4f}")
-    print(f"Diversidad: {metricas.get('diversidad', 0):.4f}")
+    if 'diversidad' in metricas:
+        print(f"Diversidad: {metricas['diversidad']:.4f}")
     print(f"Novedad: {metricas.get('novedad', 0):.4f}")
 
 
@@ -0,0 +1,92 @@
+import json
+import os
+import hashlib
+import logging
+from typing import Dict, Iterator, Optional, Tuple
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+# Los rankings (chicos, lo que leen las métricas) y las respuestas crudas del LLM (grandes)
+# van en archivos separados; ambos se enlazan por (run_id, consulta_id).
+PATH_RESULTADOS_JSONL = "eval/resultados_modelos.jsonl"
+PATH_RESPUESTAS_JSONL = "eval/respuestas_llm.jsonl"
+
+
+def agregar_registro(path: str, registro: Dict):
+    """Agrega un registro al final del archivo JSONL, en una sola línea compacta."""
+    directorio = os.path.dirname(path)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+    linea = json.dumps(registro, ensure_ascii=False, separators=(',', ':'))
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(linea + "\n")
+
+
+def leer_registros(path: str, offset: int = 0) -> Iterator[Tuple[Dict, int]]:
+    """
+    Recorre el JSONL desde `offset` (en bytes) sin cargarlo entero en memoria.
+
+    Devuelve pares (registro, offset de la línea siguiente), de modo que quien consume puede
+    guardar hasta dónde leyó y retomar desde ahí. Una última línea incompleta (un proceso
+    que todavía está escribiendo) se deja para la próxima lectura.
+    """
+    if not os.path.exists(path):
+        logger.warning(f"No existe el archivo de resultados {path}.")
+        return
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for linea in f:
+            if not linea.endswith(b"\n"):
+                break
+            offset += len(linea)
+            if linea.strip():
+                yield json.loads(linea), offset
+
+
+def convertir_json_legado(
+    path_json: str,
+    path_resultados: str = PATH_RESULTADOS_JSONL,
+    path_respuestas: str = PATH_RESPUESTAS_JSONL,
+    run_id: Optional[str] = None
+) -> int:
+    """
+    Migra un resultados_modelos.json (lista indentada) al formato JSONL separado.
+
+    Por defecto el run_id se deriva del contenido del archivo, así que migrar dos veces el
+    mismo archivo no duplica la corrida: si ese run_id ya está en el log, no se hace nada.
+    """
+    with open(path_json, 'rb') as f:
+        contenido = f.read()
+    resultados = json.loads(contenido.decode('utf-8'))
+    if run_id is None:
+        run_id = "legado-" + hashlib.sha256(contenido).hexdigest()[:12]
+
+    if os.path.exists(path_resultados) and any(
+        registro.get('run_id') == run_id for registro, _ in leer_registros(path_resultados)
+    ):
+        logger.warning(f"La corrida '{run_id}' ya está en {path_resultados}; no se vuelve a migrar.")
+        return 0
+
+    for i, resultado in enumerate(resultados):
+        agregar_registro(path_resultados, {
+            "run_id": run_id,
+            "consulta_id": i + 1,
+            "consulta": resultado['consulta'],
+            "ground_truth": resultado['ground_truth'],
+            "resultados": resultado['resultados'],
+        })
+        for modelo, clave in (("LLM_Puro", "respuesta_llm_puro"), ("Hibrido", "respuesta_hibrida")):
+            if clave in resultado:
+                agregar_registro(path_respuestas, {
+                    "run_id": run_id,
+                    "consulta_id": i + 1,
+                    "modelo": modelo,
+                    "respuesta": resultado[clave],
+                })
+
+    logger.info(f"Migrados {len(resultados)} registros de {path_json} a {path_resultados}")
+    return len(resultados)
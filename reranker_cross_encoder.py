@@ -0,0 +1,51 @@
+import logging
+from typing import Dict
+
+import pandas as pd
+from sentence_transformers import CrossEncoder
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Constantes ---
+# Cross-encoder multilingüe (las consultas y descripciones están en español)
+MODELO_CROSS_ENCODER_DEFECTO = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+MAX_LONGITUD_CROSS_ENCODER = 512
+
+# El modelo se carga una sola vez por proceso: cargarlo en cada consulta costaría más que el re-ranking
+_modelos_cargados: Dict[str, CrossEncoder] = {}
+
+
+def cargar_cross_encoder(nombre_modelo: str = MODELO_CROSS_ENCODER_DEFECTO) -> CrossEncoder:
+    """Devuelve el cross-encoder pedido, cargándolo la primera vez (en CPU si no hay GPU)."""
+    if nombre_modelo not in _modelos_cargados:
+        logger.info(f"Cargando cross-encoder: {nombre_modelo}")
+        _modelos_cargados[nombre_modelo] = CrossEncoder(nombre_modelo, max_length=MAX_LONGITUD_CROSS_ENCODER)
+    return _modelos_cargados[nombre_modelo]
+
+
+def reordenar_con_cross_encoder(
+    consulta: str,
+    df_candidatos: pd.DataFrame,
+    nombre_modelo: str = MODELO_CROSS_ENCODER_DEFECTO
+) -> pd.DataFrame:
+    """
+    Re-ordena los candidatos de SBERT puntuando cada par (consulta, producto) con un cross-encoder.
+
+    Todos los pares se puntúan en una única pasada batcheada. Devuelve una copia de
+    `df_candidatos` con la columna `score_cross_encoder`, ordenada de mayor a menor.
+    """
+    if df_candidatos.empty:
+        return df_candidatos.copy()
+
+    modelo = cargar_cross_encoder(nombre_modelo)
+    pares = [
+        (consulta, f"{nombre}. {descripcion}")
+        for nombre, descripcion in zip(df_candidatos['nombre'], df_candidatos['descripcion'])
+    ]
+    scores = modelo.predict(pares, batch_size=len(pares), show_progress_bar=False)
+
+    reordenados = df_candidatos.copy()
+    reordenados['score_cross_encoder'] = scores
+    return reordenados.sort_values('score_cross_encoder', ascending=False, kind='stable')